@@ -0,0 +1,106 @@
+import asyncio
+import os
+import time
+
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+import httpx
+from sqlalchemy.exc import SQLAlchemyError
+
+from database.crud import get_host_circuits, record_host_failure, claim_host_probe, close_host_circuit
+from logging_config import prm_logger as logger
+from settings import settings
+
+
+class HostUnavailableError(httpx.RequestError):
+    """The circuit of the host is open: no request was sent."""
+
+
+class CircuitBreaker:
+    """Per-host circuit breaker, shared by all (worker) processes through the pid_host_circuit table.
+    Closed: requests are sent. After `threshold` consecutive failures (connection errors, timeouts) the circuit opens:
+    requests fail fast with HostUnavailableError for `open_for`. Then it is half-open: one request, of any process,
+    claims the probe. Its success closes the circuit, its failure opens it again.
+    Failures are written through; each process reads the failing hosts at most every `refresh` seconds.
+    If the database is unavailable, requests are let through (the breaker fails open)."""
+
+    def __init__(self, threshold: int, window: float, open_for: float, probe_lease: float, refresh: float):
+        self.threshold = threshold
+        self.window = timedelta(seconds=window)
+        self.open_for = timedelta(seconds=open_for)
+        self.probe_lease = timedelta(seconds=probe_lease)
+        self.refresh = refresh
+        self._circuits: dict[str, tuple[int, Optional[datetime]]] = {}  # failing host -> (failures, opened_until)
+        self._refreshed = 0.0
+        self._refreshing = False
+        self._pid: Optional[int] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.threshold > 0
+
+    async def before_request(self, request: httpx.Request) -> None:
+        """Raises HostUnavailableError if the circuit of the host of the request is open (or another request probes it)."""
+        if not self.enabled:
+            return
+        await self._refresh()
+        host = request.url.host
+        circuit = self._circuits.get(host)
+        if circuit is None or circuit[1] is None:
+            return
+        failures, opened_until = circuit
+        if opened_until <= datetime.now():
+            claimed, opened_until = await self._db(claim_host_probe, host, self.probe_lease) or (False, None)
+            if claimed or opened_until is None or opened_until <= datetime.now():
+                return  # the probe, or closed (by another process) in the meantime, or the database is unavailable
+            self._circuits[host] = (failures, opened_until)
+        raise HostUnavailableError(f"Host unavailable: {host} failed {failures} times, circuit open until "
+                                   f"{opened_until:%Y-%m-%d %H:%M:%S}.", request=request)
+
+    async def record_success(self, host: str) -> None:
+        circuit = self._circuits.pop(host, None)
+        if circuit is not None:
+            await self._db(close_host_circuit, host)
+            if circuit[1] is not None:
+                logger.info("Circuit of %s closed.", host)
+
+    async def record_failure(self, host: str) -> None:
+        if not self.enabled:
+            return
+        circuit = await self._db(record_host_failure, host, self.threshold, self.window, self.open_for)
+        if circuit is not None:
+            if circuit[1] is not None and self._circuits.get(host, (0, None))[1] != circuit[1]:
+                logger.warning("Circuit of %s opened after %s failures, until %s.", host, circuit[0],
+                               circuit[1].replace(microsecond=0))
+            self._circuits[host] = circuit
+
+    async def _refresh(self) -> None:
+        if self._pid != os.getpid():  # forked: a refresh in flight did not come along
+            self._pid, self._refreshing, self._refreshed = os.getpid(), False, 0.0
+        if self._refreshing or time.monotonic() - self._refreshed < self.refresh:
+            return
+        self._refreshing = True  # other requests go on with the current state
+        try:
+            circuits = await self._db(get_host_circuits, self.window)
+            if circuits is not None:
+                self._circuits = circuits
+        finally:
+            self._refreshed = time.monotonic()
+            self._refreshing = False
+
+    @staticmethod
+    async def _db(function: Callable, *args):
+        """Runs the (blocking) database function in a thread. Returns None if the database is unavailable."""
+        try:
+            return await asyncio.to_thread(function, *args)
+        except SQLAlchemyError as e:
+            logger.error("Circuit breaker: %s failed: %s", function.__name__, e)
+            return None
+
+
+circuit_breaker = CircuitBreaker(threshold=settings.PIDRESOLVER_CIRCUIT_THRESHOLD,
+                                 window=settings.PIDRESOLVER_CIRCUIT_WINDOW,
+                                 open_for=settings.PIDRESOLVER_CIRCUIT_OPEN,
+                                 probe_lease=settings.PIDRESOLVER_TIMEOUT + settings.PIDRESOLVER_READ_TIMEOUT,
+                                 refresh=settings.PIDRESOLVER_CIRCUIT_REFRESH)
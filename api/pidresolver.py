@@ -1,13 +1,38 @@
+import asyncio
 import httpx
-import idutils
+import re
+import ssl
+import time
 
+from collections import defaultdict, deque
 from datetime import datetime
-from typing import Optional
+from functools import lru_cache
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from typing import AsyncIterator, Iterable, Optional, Union
+from urllib.parse import urlsplit
+from weakref import WeakKeyDictionary
 from pydantic import BaseModel
+from api.circuitbreaker import HostUnavailableError, circuit_breaker
+from api.scheduler import get_host_scheduler
 from settings import settings
 from logging_config import prm_logger as logger
-from tenacity import retry, stop_after_attempt, retry_if_exception_type, wait_exponential_jitter, \
-    RetryError
+from tenacity import retry, stop_after_attempt, retry_if_exception_type, retry_if_not_exception_type, \
+    wait_exponential_jitter, RetryError
+from utils.cache import TTLCache
+from utils.eventloop import run_sync
+from utils.metrics import Histogram
+
+
+class HopTiming(BaseModel):
+    """Timings (ms) of one request of a resolution: the PID URL or one of its redirects.
+    connect_ms (DNS lookup and TCP connect) and tls_ms are None if the request went over a pooled connection."""
+    host: str
+    status_code: Optional[int]  # None: the request failed
+    wait_ms: int  # waiting for a slot of the host (HostScheduler)
+    connect_ms: Optional[int]
+    tls_ms: Optional[int]
+    ttfb_ms: Optional[int]  # request sent until the response headers were received
+    total_ms: int
 
 
 class ResolutionRecord(BaseModel):
@@ -19,34 +44,299 @@ class ResolutionRecord(BaseModel):
     redirect_count: Optional[int]
     resolution_url: Optional[str]
     http_error: Optional[str]
+    cached: bool = False  # True if the result was shared with another (concurrent or recent) resolution of the PID
+    elapsed_ms: Optional[int] = None  # duration of the resolution, including retries
+    hops: list[HopTiming] = []  # the requests of the (last attempt of the) resolution
+
+
+# Recent results by actionable URL, and the resolutions in flight (per event loop) that concurrent requests can join.
+resolution_cache = TTLCache(max_size=settings.PIDRESOLVER_CACHE_SIZE, ttl=settings.PIDRESOLVER_CACHE_TTL)
+_in_flight: WeakKeyDictionary[asyncio.AbstractEventLoop, dict[str, asyncio.Future]] = WeakKeyDictionary()
+coalesced_resolutions = 0
+resolution_seconds = Histogram("prm_pid_resolution_seconds",
+                               "PID resolutions (not cached), by resolver host and outcome.", ("host", "outcome"),
+                               max_series=settings.METRICS_MAX_HOST_SERIES)
+
+# One pooled client per event loop and SSL verification mode. Clients are bound to the loop they were created on.
+_async_clients: WeakKeyDictionary[asyncio.AbstractEventLoop, dict[bool, httpx.AsyncClient]] = WeakKeyDictionary()
+
+
+def get_async_client(verify: bool) -> httpx.AsyncClient:
+    """Returns the shared AsyncClient of the running event loop. Connections are pooled and kept alive between PIDs."""
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(verify)
+    if client is None or client.is_closed:
+        # https://www.python-httpx.org/advanced/timeouts/
+        # There are four different types of timeouts that may occur. These are connect, read, write, and pool timeouts.
+        # The default behavior is to raise a TimeoutException after 5 seconds of network inactivity.
+        # Redirects are followed hop by hop in send_following_redirects(), so every hop gets a slot of its host.
+        # The client itself keeps no cookies: those are kept per resolution, not shared between (unrelated) PIDs.
+        client = httpx.AsyncClient(timeout=httpx.Timeout(settings.PIDRESOLVER_TIMEOUT,
+                                                         read=settings.PIDRESOLVER_READ_TIMEOUT),
+                                   limits=httpx.Limits(
+                                       max_connections=settings.PIDRESOLVER_MAX_CONNECTIONS,
+                                       max_keepalive_connections=settings.PIDRESOLVER_MAX_KEEPALIVE_CONNECTIONS,
+                                       keepalive_expiry=settings.PIDRESOLVER_KEEPALIVE_EXPIRY),
+                                   verify=verify,
+                                   cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+                                   headers={"user-agent": settings.PIDRESOLVER_USER_AGENT})
+        clients[verify] = client
+    return client
+
+
+async def close_async_clients() -> None:
+    """Closes the shared clients of the running event loop, e.g. on application shutdown."""
+    clients = _async_clients.pop(asyncio.get_running_loop(), {})
+    for client in clients.values():
+        await client.aclose()
 
 
+# Fast path for the dominant schemes. These are dispatched on their prefix, all other PIDs go through idutils.
+_DOI = re.compile(r'10\.\d{4,9}/\S+')
+_HANDLE = re.compile(r'[^\s/]+/\S+')
+_ARK = re.compile(r'ark:/?(\d{5,}/\S+)', re.IGNORECASE)
+_URN_NBN = re.compile(r'urn:nbn:\S+', re.IGNORECASE)
+_URL_PREFIXES = ('https://', 'http://')
+_DOI_URL_PREFIXES = tuple(f'{scheme}{host}/' for scheme in _URL_PREFIXES for host in ('doi.org', 'dx.doi.org'))
+_HANDLE_URL_PREFIXES = tuple(f'{scheme}hdl.handle.net/' for scheme in _URL_PREFIXES)
+
+
+def _fast_actionable_url(pid: str) -> Optional[str]:
+    """Returns the actionable (https) URL of a DOI, Handle, ARK, URN:NBN or http(s) URL, or None for any other form."""
+    lower = pid[:24].lower()
+    if lower.startswith(_URL_PREFIXES):
+        # The prefixes are matched case-insensitively: the positions are taken from `lower`, not from `pid`.
+        if lower.startswith(_DOI_URL_PREFIXES):
+            doi = pid[lower.index('doi.org/') + 8:]
+            return f'https://doi.org/{doi}' if doi else None  # a DOI (to idutils too), whatever its form
+        if lower.startswith(_HANDLE_URL_PREFIXES):
+            return _fast_actionable_url('hdl:' + pid[lower.index('handle.net/') + 11:])
+        return pid  # already actionable
+    if lower.startswith('doi:'):
+        return f'https://doi.org/{pid[4:]}' if _DOI.fullmatch(pid, 4) else None
+    if lower.startswith('10.') and _DOI.fullmatch(pid):
+        return f'https://doi.org/{pid}'
+    if lower.startswith('hdl:'):
+        return f'https://hdl.handle.net/{pid[4:]}' if _HANDLE.fullmatch(pid, 4) else None
+    if lower.startswith('ark:'):
+        ark = _ARK.fullmatch(pid)
+        return f'https://n2t.net/ark:/{ark.group(1)}' if ark else None
+    if lower.startswith('urn:nbn:') and _URN_NBN.fullmatch(pid):
+        return f'https://nbn-resolving.org/urn:nbn:{pid[8:]}'
+    if lower[:1].isdigit() and _HANDLE.fullmatch(pid):
+        return f'https://hdl.handle.net/{pid}'
+    return None
+
+
+def warm_up() -> None:
+    """Imports idutils ahead of the first PID that is not a DOI, Handle, ARK, URN:NBN or URL."""
+    import idutils  # noqa: F401
+
+
+@lru_cache(maxsize=settings.PIDRESOLVER_NORMALIZATION_CACHE_SIZE)
 def get_actionable_pid_url(pid: str) -> Optional[str]:
+    """Returns the actionable URL of the PID, or None if its identifier scheme is not recognised. Results are memoized."""
+    pid = pid.strip()
+    pidx = _fast_actionable_url(pid)
+    if pidx:
+        return pidx
+    import idutils  # imported on first use: it takes about half a second (see warm_up())
     id_scheme = idutils.detect_identifier_schemes(pid)
     if not id_scheme:
-        logger.warn(f"Identifier scheme not recognised: {pid}")
+        logger.warning("Identifier scheme not recognised: %s", pid)
         return None
     pidx = idutils.to_url(pid, id_scheme[0])
     if pidx.lower().startswith("http:") and pid.lower().startswith("https:"):
         pidx = pidx.lower().replace("http:", "https:")
-    return pidx
+    return pidx or None
 
 
 def resolve_url_by_pid(pid: str) -> Optional[ResolutionRecord]:
     """Resolves a persistent identifier (PID) in any form. Returns a (PID) ResolutionRecord object with the resolution results.
+    Runs on the background event loop of this process, so subsequent calls share the pooled connections.
+    :rtype: ResolutionRecord"""
+    return run_sync(resolve_url_by_pid_async(pid))
+
+
+async def resolve_url_by_pid_async(pid: str, hops: Optional[list[HopTiming]] = None) -> Optional[ResolutionRecord]:
+    """Async version of resolve_url_by_pid.
+    A PID whose actionable URL was resolved less than PIDRESOLVER_CACHE_TTL seconds ago, or is being resolved right now,
+    is not resolved again: it gets a copy of that result, with `cached` set.
+    The timings of the requests are collected in `hops`, if given, so they are also available when the resolution fails.
     :rtype: ResolutionRecord"""
+    global coalesced_resolutions
     pidx = get_actionable_pid_url(pid)
     if not pidx:
         return None
+    record = resolution_cache.get(pidx)
+    if record:
+        return record.model_copy(update={"pid_id": pid, "cached": True})
+    in_flight = _in_flight.setdefault(asyncio.get_running_loop(), {})
+    future = in_flight.get(pidx)
+    if future:
+        coalesced_resolutions += 1
+        try:
+            record = await asyncio.shield(future)
+            return record.model_copy(update={"pid_id": pid, "cached": True})
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            return await resolve_url_by_pid_async(pid, hops)  # The resolution we joined was cancelled, not this one.
+    future = in_flight[pidx] = asyncio.get_running_loop().create_future()
     try:
-        response, verified, error = resolve_pid(pidx, True)
-        return create_resolution_record(pid, pidx, response, verified, error)
+        record = await _resolve_actionable_url(pid, pidx, [] if hops is None else hops)
+        resolution_cache.put(pidx, record)
+        future.set_result(record)
+        return record
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # retrieved: there may be no one else waiting for it
+        raise
+    finally:
+        if not future.done():
+            future.cancel()
+        del in_flight[pidx]
+
+
+def get_resolution_cache_stats() -> dict:
+    return {**resolution_cache.stats(), "coalesced": coalesced_resolutions}
+
+
+async def _resolve_actionable_url(pid: str, pidx: str, hops: list[HopTiming]) -> ResolutionRecord:
+    start = time.perf_counter()
+    host = urlsplit(pidx).hostname or ''
+    outcome = "error"
+    try:
+        response, verified, error = await resolve_pid(pidx, hops)
+        record = create_resolution_record(pid, pidx, response, verified, error, hops=hops,
+                                          elapsed_ms=_ms(time.perf_counter() - start))
+        outcome = f"{record.status_code // 100}xx" if record.status_code else "error"
+        return record
+    except HostUnavailableError:
+        outcome = "host_unavailable"
+        raise
     except RetryError as e:
         raise e.last_attempt.exception()  # Tenacity back-off failed. Raise the last Exception, so that the task can be rescheduled.
+    finally:
+        resolution_seconds.observe(time.perf_counter() - start, host, outcome)
+
+
+async def resolve_pids(pids: Iterable[str], concurrency: Optional[int] = None) -> AsyncIterator[ResolutionRecord]:
+    """Resolves the PIDs concurrently over the shared client and yields the ResolutionRecords as they complete.
+    At most `concurrency` PIDs are in flight, and the PIDs are consumed lazily, so any (large) iterable can be passed.
+    PIDs of a resolver host that is at its in-flight limit (see HostScheduler) are set aside, so that they do not take
+    the place of PIDs for other hosts (no head-of-line blocking). A PID counts against its resolver host until the
+    resolver answered: the redirect hops that follow wait for the slots of their own hosts only.
+    PIDs that could not be resolved, or are malformed, yield a record with the http_error set; unrecognised identifiers
+    are skipped.
+    Closing the generator cancels the outstanding resolutions."""
+    limit = concurrency or settings.PIDRESOLVER_CONCURRENCY
+    scheduler = get_host_scheduler()
+    pid_iter = iter(pids)
+    exhausted = False
+    pending: set[asyncio.Task] = set()
+    resolving: dict[asyncio.Future, str] = {}  # the first hop of a PID -> its resolver host, until the resolver answered
+    in_flight: dict[str, int] = defaultdict(int)
+    backlog: dict[str, deque[str]] = {}
+    backlog_size = 0
+
+    def start(pid: str, host: str) -> None:
+        hops = _Hops()
+        task = asyncio.create_task(_resolve_or_fail(pid, hops))
+        task.add_done_callback(lambda _: hops.first_done())  # e.g. a cached result, or no request at all
+        pending.add(task)
+        resolving[hops.first] = host
+        in_flight[host] += 1
+
+    try:
+        while True:
+            for host in list(backlog):
+                queue = backlog[host]
+                while queue and len(pending) < limit and in_flight[host] < scheduler.max_in_flight(host):
+                    start(queue.popleft(), host)
+                    backlog_size -= 1
+                if not queue:
+                    del backlog[host]
+            # Read ahead (bounded) to find work for other hosts while the set aside hosts are saturated.
+            while not exhausted and len(pending) < limit and backlog_size < limit:
+                pid = next(pid_iter, None)
+                if pid is None:
+                    exhausted = True
+                    break
+                host = _pid_host(pid)
+                if in_flight[host] < scheduler.max_in_flight(host):
+                    start(pid, host)
+                else:
+                    backlog.setdefault(host, deque()).append(pid)
+                    backlog_size += 1
+            if not pending and not resolving:
+                return
+            done, _ = await asyncio.wait(pending | resolving.keys(), return_when=asyncio.FIRST_COMPLETED)
+            for future in done:
+                if future in resolving:
+                    host = resolving.pop(future)
+                    in_flight[host] -= 1
+                    if not in_flight[host]:
+                        del in_flight[host]
+                    continue
+                pending.remove(future)
+                record = future.result()
+                if record:
+                    yield record
+    finally:
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+
+
+def _pid_host(pid: str) -> str:
+    """The resolver host of the PID; '' if there is none, or if the PID is malformed (see _resolve_or_fail)."""
+    try:
+        pidx = get_actionable_pid_url(pid)
+        return urlsplit(pidx).hostname or '' if pidx else ''
+    except ValueError:
+        return ''
+
+
+class _Hops(list):
+    """The hop timings of a resolution; `first` is done once the first request (to the resolver) completed."""
+
+    def __init__(self):
+        super().__init__()
+        self.first = asyncio.get_running_loop().create_future()
+
+    def append(self, hop: HopTiming) -> None:
+        super().append(hop)
+        self.first_done()
+
+    def first_done(self) -> None:
+        if not self.first.done():
+            self.first.set_result(None)
+
+
+async def _resolve_or_fail(pid: str, hops: Optional[list[HopTiming]] = None) -> Optional[ResolutionRecord]:
+    """Resolves the PID. Any error, also of a malformed PID (e.g. ValueError: Invalid IPv6 URL, httpx.InvalidURL), is
+    returned as the error record of the PID, so that it does not fail the resolution of the others."""
+    start = time.perf_counter()
+    hops = [] if hops is None else hops
+    try:
+        return await resolve_url_by_pid_async(pid, hops)
+    except Exception as e:
+        if isinstance(e, httpx.HTTPError):
+            logger.debug("PID %s resolution failed. Error: %s.", pid, e, extra={"event": "pid_resolution_failed"})
+        else:
+            logger.warning("PID %s could not be resolved: %r", pid, e, extra={"event": "pid_resolution_failed"})
+        try:
+            pidx = get_actionable_pid_url(pid) or pid
+        except ValueError:
+            pidx = pid
+        return create_resolution_record(pid, pidx, None, False, str(e) or type(e).__name__, hops=hops,
+                                        elapsed_ms=_ms(time.perf_counter() - start))
 
 
 def create_resolution_record(pid: str, pidx: str, response: Optional[httpx.Response], verified: bool,
-                             error: Optional[str]) -> ResolutionRecord:
+                             error: Optional[str], hops: Iterable[HopTiming] = (),
+                             elapsed_ms: Optional[int] = None) -> ResolutionRecord:
     """Create a ResolutionRecord based on the PID resolution response.
     :rtype: ResolutionRecord
     """
@@ -58,31 +348,183 @@ def create_resolution_record(pid: str, pidx: str, response: Optional[httpx.Respo
         ssl_verified=verified,
         redirect_count=len(response.history) if response else None,
         resolution_url=str(response.url) if response else None,
-        http_error=str(error) if response is None else None
+        http_error=str(error) if response is None else None,
+        elapsed_ms=elapsed_ms,
+        hops=list(hops)
     )
 
 
 @retry(
     wait=wait_exponential_jitter(initial=2, jitter=1.5),
     stop=stop_after_attempt(2),
-    retry=retry_if_exception_type(httpx.HTTPError)
+    retry=retry_if_exception_type(httpx.HTTPError) & retry_if_not_exception_type(HostUnavailableError)
 )
-def resolve_pid(pid: str, verify: bool) -> tuple[Optional[httpx.Response], bool, Optional[str]]:
-    """Attempt to resolve the PID, following redirects, bypassing SSL validation if needed."""
-
-    # https://www.python-httpx.org/advanced/timeouts/
-    # There are four different types of timeouts that may occur. These are connect, read, write, and pool timeouts.
-    # The default behavior is to raise a TimeoutException after 5 seconds of network inactivity.
-    client = httpx.Client(follow_redirects=True,
-                          timeout=httpx.Timeout(settings.PIDRESOLVER_TIMEOUT, read=settings.PIDRESOLVER_READ_TIMEOUT),
-                          verify=verify,
-                          max_redirects=settings.PIDRESOLVER_MAX_REDIR,
-                          headers={"user-agent": settings.PIDRESOLVER_USER_AGENT})
+async def resolve_pid(pid: str, hops: Optional[list[HopTiming]] = None) \
+        -> tuple[Optional[httpx.Response], bool, Optional[str]]:
+    """Attempt to resolve the PID, following redirects, bypassing SSL validation for hosts with an invalid certificate.
+    The timings of the requests of this attempt are collected in `hops`."""
+    if hops is not None:
+        hops.clear()  # a new attempt
+    response, verified = await send_following_redirects(pid, hops)
+    return response, verified, None
+
+
+async def send_following_redirects(url: str, hops: Optional[list[HopTiming]] = None) -> tuple[httpx.Response, bool]:
+    """Requests the URL and follows the redirects. Each hop waits for a slot of its host on the HostScheduler.
+    Returns the final response, with the redirect responses in its history, and whether the certificates of all hops
+    were verified. The timings of each hop, also of a failed one, are appended to `hops`.
+    See PIDRESOLVER_RESOLUTION_MODE for the method and how much of the body is read."""
+    cookies = httpx.Cookies()
+    history: list[httpx.Response] = []
+    verified = True
+    client = get_async_client(True)  # builds the requests; they are sent by the client of their TLS verdict
+    request = _build_request(client, url, cookies)
+    while True:
+        response, hop_verified = await _send_verified(request, hops)
+        if request.method == "HEAD" and response.status_code in _HEAD_REJECTED:
+            head = response
+            request = client.build_request("GET", request.url, cookies=cookies)
+            response, hop_verified = await _send_verified(request, hops)
+            if response.status_code != head.status_code:
+                head_rejecting_hosts.put(request.url.host, True)
+                logger.debug("%s rejects HEAD requests (HTTP %s), using GET.", request.url.host, head.status_code)
+        verified = verified and hop_verified
+        cookies.extract_cookies(response)
+        if response.next_request is None:
+            response.history = history
+            return response, verified
+        if len(history) >= settings.PIDRESOLVER_MAX_REDIR:
+            raise httpx.TooManyRedirects("Exceeded maximum allowed redirects.", request=request)
+        history.append(response)
+        request = _build_request(client, response.next_request.url, cookies)
+
+
+# TLS verdict per host. The certificate of a host with an "invalid_cert" or "expired" verdict is not verified.
+TLS_VALID, TLS_INVALID_CERT, TLS_EXPIRED = "valid", "invalid_cert", "expired"
+tls_verdicts = TTLCache(max_size=settings.PIDRESOLVER_CACHE_SIZE, ttl=settings.PIDRESOLVER_TLS_VERDICT_TTL)
+_X509_V_ERR_CERT_HAS_EXPIRED = 10
+
+
+async def _send_verified(request: httpx.Request, hops: Optional[list[HopTiming]]) -> tuple[httpx.Response, bool]:
+    """Sends the request with certificate verification, unless its host has an invalid certificate (TLS verdict).
+    Only a certificate verification failure is repeated without verification, other errors are raised.
+    Returns the response and whether it was verified."""
+    host = request.url.host
+    verdict = tls_verdicts.get(host) if request.url.scheme == "https" else TLS_VALID
+    if verdict in (None, TLS_VALID):
+        try:
+            response = await _send(get_async_client(True), request, hops)
+            if verdict is None:
+                tls_verdicts.put(host, TLS_VALID)
+            return response, True
+        except httpx.ConnectError as e:
+            error = _cause(e, ssl.SSLCertVerificationError)
+            if error is None:
+                raise
+            verdict = TLS_EXPIRED if error.verify_code == _X509_V_ERR_CERT_HAS_EXPIRED else TLS_INVALID_CERT
+            tls_verdicts.put(host, verdict)
+            logger.info("TLS certificate of %s: %s (%s), not verified from now on.", host, verdict, error.verify_message)
+    return await _send(get_async_client(False), request, hops), False
+
+
+# Statuses of a HEAD request that may mean that the host does not support HEAD. The hop is repeated with GET.
+_HEAD_REJECTED = frozenset({400, 403, 404, 405, 501})
+# Hosts whose HEAD and GET responses differed, resolved with GET only (PIDRESOLVER_RESOLUTION_MODE = "head").
+head_rejecting_hosts = TTLCache(max_size=settings.PIDRESOLVER_CACHE_SIZE, ttl=settings.PIDRESOLVER_HEAD_FALLBACK_TTL)
+
+
+def _build_request(client: httpx.AsyncClient, url: Union[str, httpx.URL], cookies: httpx.Cookies) -> httpx.Request:
+    url = httpx.URL(url)
+    head = settings.PIDRESOLVER_RESOLUTION_MODE == "head" and not head_rejecting_hosts.get(url.host)
+    return client.build_request("HEAD" if head else "GET", url, cookies=cookies)
+
+
+# Errors that count against the host (circuit breaker), unlike those of the request itself (e.g. UnsupportedProtocol of
+# a redirect to ftp: or mailto:).
+_HOST_FAILURES = (httpx.ConnectTimeout, httpx.ReadTimeout, httpx.PoolTimeout, httpx.ConnectError,
+                  httpx.RemoteProtocolError)
+
+
+async def _send(client: httpx.AsyncClient, request: httpx.Request, hops: Optional[list[HopTiming]]) -> httpx.Response:
+    """Sends the request in a slot of its host and reads (part of) the body, see _read_body(). Appends its timings.
+    Raises HostUnavailableError, without sending it, if the circuit of the host is open."""
+    await circuit_breaker.before_request(request)
+    trace = _PhaseTrace()
+    request.extensions["trace"] = trace
+    response = None
+    start = time.perf_counter()
     try:
-        response = client.get(pid)
-        return response, verify, None
-    except httpx.HTTPError as error:  # See: https://www.python-httpx.org/exceptions/ & https://www.python-httpx.org/quickstart/#exceptions
-        if verify:
-            return resolve_pid(pid, False)
-        else:
-            raise error
+        async with get_host_scheduler().slot(request.url.host):
+            trace.sent = time.perf_counter()
+            response = await client.send(request, stream=True)
+            try:
+                await _read_body(response)
+            finally:
+                await response.aclose()
+        await circuit_breaker.record_success(request.url.host)
+        return response
+    except _HOST_FAILURES as e:
+        if _cause(e, ssl.SSLCertVerificationError) is None:  # Else the host did answer.
+            await circuit_breaker.record_failure(request.url.host)
+        raise
+    finally:
+        if hops is not None:
+            hops.append(trace.hop_timing(request.url.host, response, start))
+
+
+async def _read_body(response: httpx.Response) -> None:
+    """Reads the whole body in "get" mode. Otherwise only small bodies of a known length (closing the connection in the
+    middle of a body would discard it from the pool) and the first PIDRESOLVER_BODY_PREFIX bytes, which are kept in
+    response.extensions["body_prefix"]."""
+    length = response.headers.get("content-length", "")
+    if (settings.PIDRESOLVER_RESOLUTION_MODE == "get"
+            or length.isdigit() and int(length) <= settings.PIDRESOLVER_KEEPALIVE_BODY_SIZE):
+        await response.aread()
+    elif settings.PIDRESOLVER_BODY_PREFIX > 0:
+        prefix = bytearray()
+        async for chunk in response.aiter_bytes():
+            prefix += chunk
+            if len(prefix) >= settings.PIDRESOLVER_BODY_PREFIX:
+                break
+        response.extensions["body_prefix"] = bytes(prefix[:settings.PIDRESOLVER_BODY_PREFIX])
+
+
+def _cause(error: Optional[BaseException], error_type: type[BaseException]) -> Optional[BaseException]:
+    """Returns the error, or the first error in its chain of causes, of the type. None if there is none."""
+    while error is not None:
+        if isinstance(error, error_type):
+            return error
+        error = error.__cause__ or error.__context__
+    return None
+
+
+def _ms(seconds: Optional[float]) -> Optional[int]:
+    return None if seconds is None else round(seconds * 1000)
+
+
+class _PhaseTrace:
+    """httpcore "trace" extension: records when the phases of a request started and completed.
+    https://www.encode.io/httpcore/extensions/#trace"""
+
+    def __init__(self):
+        self.sent: Optional[float] = None  # the request got its host slot
+        self.events: dict[str, float] = {}
+
+    async def __call__(self, event_name: str, info: dict) -> None:
+        # Events are named <prefix>.<phase>.<started|complete|failed>, e.g. "connection.connect_tcp.started".
+        self.events[event_name.partition(".")[2]] = time.perf_counter()
+
+    def _duration(self, start_event: str, end_event: str) -> Optional[float]:
+        start, end = self.events.get(start_event), self.events.get(end_event)
+        return end - start if start is not None and end is not None else None
+
+    def hop_timing(self, host: str, response: Optional[httpx.Response], start: float) -> HopTiming:
+        return HopTiming(
+            host=host,
+            status_code=response.status_code if response is not None else None,
+            wait_ms=_ms((self.sent or time.perf_counter()) - start),
+            connect_ms=_ms(self._duration("connect_tcp.started", "connect_tcp.complete")),
+            tls_ms=_ms(self._duration("start_tls.started", "start_tls.complete")),
+            ttfb_ms=_ms(self._duration("send_request_headers.started", "receive_response_headers.complete")),
+            total_ms=_ms(time.perf_counter() - start)
+        )
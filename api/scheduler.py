@@ -0,0 +1,122 @@
+import asyncio
+import time
+
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, NamedTuple, Optional
+from weakref import WeakKeyDictionary
+from settings import settings
+
+
+class HostLimits(NamedTuple):
+    rate: float  # requests per second, 0 = unlimited
+    burst: int  # bucket size: number of requests that may be sent at once after an idle period
+    max_in_flight: int  # concurrent requests (connections) to the host
+
+
+class TokenBucket:
+    """Async token bucket. Waiters for this bucket sleep, without blocking work for other hosts."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        async with self._lock:  # Waiters are served in order (FIFO), so no request for this host starves.
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class _HostState:
+    def __init__(self, limits: HostLimits):
+        self.limits = limits
+        self.bucket = TokenBucket(limits.rate, limits.burst)
+        self.semaphore = asyncio.Semaphore(limits.max_in_flight)
+        self.users = 0  # requests waiting for, or holding, a slot
+
+
+class HostScheduler:
+    """Per-host politeness: a token bucket (rate limit) and a cap on the in-flight requests for every target host.
+    Every request, including each redirect hop, must be sent within a `slot()` of its host.
+    Limits are configured by PIDRESOLVER_HOST_LIMITS (exact host or parent domain), else by the PIDRESOLVER_HOST_* defaults.
+    The state lives in one event loop: get_host_scheduler() gives each event loop its share of the (global) limits."""
+
+    max_idle_hosts = 10000  # The state of idle hosts is dropped beyond this number (landing page hosts are countless).
+
+    def __init__(self, default_limits: HostLimits, host_limits: Optional[dict[str, HostLimits]] = None):
+        self.default_limits = default_limits
+        self.host_limits = host_limits or {}
+        self._hosts: dict[str, _HostState] = {}
+
+    def limits_for(self, host: str) -> HostLimits:
+        """Returns the limits of the host, or of its closest configured parent domain (dx.doi.org -> doi.org)."""
+        labels = host.lower().split('.')
+        for i in range(len(labels)):
+            limits = self.host_limits.get('.'.join(labels[i:]))
+            if limits:
+                return limits
+        return self.default_limits
+
+    def _state(self, host: str) -> _HostState:
+        state = self._hosts.get(host)
+        if state is None:
+            if len(self._hosts) >= self.max_idle_hosts:
+                self._hosts = {h: s for h, s in self._hosts.items() if s.users}
+            state = self._hosts[host] = _HostState(self.limits_for(host))
+        return state
+
+    def max_in_flight(self, host: str) -> int:
+        return self._state(host).limits.max_in_flight
+
+    @asynccontextmanager
+    async def slot(self, host: str) -> AsyncIterator[None]:
+        state = self._state(host)
+        state.users += 1
+        try:
+            async with state.semaphore:
+                await state.bucket.acquire()
+                yield
+        finally:
+            state.users -= 1
+
+
+def share_of(limits: HostLimits, shares: int) -> HostLimits:
+    """The share of one of `shares` event loops of the global limits, so that together they stay within them."""
+    return HostLimits(rate=limits.rate / shares, burst=max(1, limits.burst // shares),
+                      max_in_flight=max(1, limits.max_in_flight // shares))
+
+
+def _limits_from_settings() -> tuple[HostLimits, dict[str, HostLimits]]:
+    """The limits of one event loop: its share (PIDRESOLVER_HOST_LIMIT_SHARES) of the configured, global limits."""
+    shares = max(1, settings.PIDRESOLVER_HOST_LIMIT_SHARES)
+    default_limits = HostLimits(rate=settings.PIDRESOLVER_HOST_RATE, burst=settings.PIDRESOLVER_HOST_BURST,
+                                max_in_flight=settings.PIDRESOLVER_HOST_MAX_IN_FLIGHT)
+    host_limits = {}
+    for host, limits in settings.get('PIDRESOLVER_HOST_LIMITS', {}).items():
+        host_limits[host.lower()] = share_of(HostLimits(
+            rate=limits.get('rate', default_limits.rate), burst=limits.get('burst', default_limits.burst),
+            max_in_flight=limits.get('max_in_flight', default_limits.max_in_flight)), shares)
+    return share_of(default_limits, shares), host_limits
+
+
+# asyncio primitives are bound to the loop they are used on: one scheduler per event loop.
+_schedulers: WeakKeyDictionary[asyncio.AbstractEventLoop, HostScheduler] = WeakKeyDictionary()
+
+
+def get_host_scheduler() -> HostScheduler:
+    """Returns the HostScheduler of the running event loop."""
+    loop = asyncio.get_running_loop()
+    scheduler = _schedulers.get(loop)
+    if scheduler is None:
+        scheduler = _schedulers[loop] = HostScheduler(*_limits_from_settings())
+    return scheduler
@@ -1,8 +1,12 @@
 import datetime
-import dbm
 import json
 import os
-from typing import List
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Callable, List, Optional
 
 import httpx
 from dateutil.relativedelta import relativedelta
@@ -11,107 +15,209 @@ from logging_config import prm_logger as logger
 from settings import settings
 
 
+# PID Graph ID -> UptimeRobot monitor id. Immutable: a rebuild swaps in a new mapping, so readers never see a partial one.
+_monitors_mapping: Optional[MappingProxyType] = None
+_mapping_rebuild_lock = threading.Lock()
+
+
+def get_monitors_mapping() -> MappingProxyType:
+    """Returns the current mapping; the first call loads the snapshot (empty if there is none)."""
+    if _monitors_mapping is None:
+        set_monitors_mapping(load_mapping_snapshot())
+    return _monitors_mapping
+
+
+def set_monitors_mapping(mapping: dict[str, str]) -> None:
+    global _monitors_mapping
+    _monitors_mapping = MappingProxyType(dict(mapping))
+
+
+def load_mapping_snapshot() -> dict[str, str]:
+    try:
+        with open(settings.UPTIME_MONITORS_MAPPING_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        logger.error("Invalid UptimeRobot mapping snapshot %s: %s", settings.UPTIME_MONITORS_MAPPING_FILE, e)
+        return {}
+
+
+def save_mapping_snapshot(mapping: dict[str, str]) -> None:
+    """Writes the snapshot to a temporary file, then renames it (atomic): a reader gets the old or the new snapshot."""
+    path = settings.UPTIME_MONITORS_MAPPING_FILE
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+        json.dump(mapping, f)
+    os.replace(f.name, path)
+
+
+class MonitorUptimeCache:
+    """Per-monitor uptimes (over the last year), refreshed in the background every `refresh_interval` seconds.
+    Cached uptimes are served also when they are due for a refresh, or when the refresh fails (stale-while-revalidate):
+    only a monitor that was never fetched waits for UptimeRobot."""
+
+    def __init__(self, fetch: Callable[[List[str]], dict[str, Optional[dict]]], refresh_interval: float):
+        self._fetch = fetch
+        self.refresh_interval = refresh_interval
+        self._entries: dict[str, tuple[float, Optional[dict]]] = {}  # monitor id -> (fetched, monitor or None: unknown)
+        self._lock = threading.Lock()  # writers; readers use the current dict, which is replaced, never changed
+        self._wakeup = threading.Event()
+        self._pid: Optional[int] = None
+
+    def get(self, monitor_ids: List[str]) -> List[dict]:
+        """Returns the monitors, leaving out unknown monitor ids. Raises an Exception if a monitor that is not cached
+        cannot be fetched."""
+        self._ensure_refresher()
+        entries = self._entries
+        missing = [monitor_id for monitor_id in monitor_ids if monitor_id not in entries]
+        if missing:
+            self._store(self._fetch(missing))
+            entries = self._entries
+        now = time.monotonic()
+        monitors = []
+        for monitor_id in monitor_ids:
+            fetched, monitor = entries[monitor_id]
+            if now - fetched > self.refresh_interval:
+                self._wakeup.set()  # revalidate now, in the background
+            if monitor is None:
+                logger.error("UptimeRobot monitor not found: %s", monitor_id)
+            else:
+                monitors.append(monitor)
+        return monitors
+
+    def _store(self, monitors: dict[str, Optional[dict]]) -> None:
+        fetched = time.monotonic()
+        with self._lock:
+            self._entries = {**self._entries, **{monitor_id: (fetched, monitor) for monitor_id, monitor in monitors.items()}}
+
+    def _ensure_refresher(self) -> None:
+        # Started lazily, in the process that uses it (threads do not survive a fork).
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                threading.Thread(target=self._refresh_due, name="prm-uptime-refresher", daemon=True).start()
+
+    def _refresh_due(self) -> None:
+        while True:
+            self._wakeup.wait(self.refresh_interval / 2)
+            self._wakeup.clear()
+            now = time.monotonic()
+            due = [monitor_id for monitor_id, (fetched, _) in self._entries.items()
+                   if now - fetched >= self.refresh_interval / 2]
+            if not due:
+                continue
+            try:
+                self._store(self._fetch(due))
+                logger.debug("Refreshed the uptime of %s UptimeRobot monitors.", len(due))
+            except Exception as e:
+                logger.warning("Refreshing the uptime of %s UptimeRobot monitors failed, serving cached values: %s",
+                               len(due), e)
+                time.sleep(min(self.refresh_interval / 2, 60))  # back off: requests keep asking for a revalidation
+
+
 class UptimeRobot:
 
     uptimerobot_api_key = os.getenv('UPTIMEROBOT_API_KEY')
+    api_url = settings.UPTIMEROBOT_API_URL
+    page_limit = 50  # max. monitors per getMonitors request
+    _client: Optional[httpx.Client] = None
+
+    def _get_monitors(self, **params) -> dict:
+        """POSTs a getMonitors request, over a shared client. Raises an Exception if it fails."""
+        if UptimeRobot._client is None:
+            UptimeRobot._client = httpx.Client(headers={"user-agent": settings.PIDRESOLVER_USER_AGENT,
+                                                        "Content-Type": "application/x-www-form-urlencoded"},
+                                               timeout=settings.UPTIMEROBOT_TIMEOUT)
+        response = UptimeRobot._client.post(f'{self.api_url}/getMonitors',
+                                            data={"api_key": self.uptimerobot_api_key, "format": "json", "logs": 0, **params})
+        response.raise_for_status()
+        data = response.json()
+        if data["stat"] == "fail":
+            raise Exception(data["error"]["message"])
+        return data
 
     def update_monitors_mapping(self) -> int:
-        httpx_client = httpx.Client(headers={"user-agent": settings.PIDRESOLVER_USER_AGENT,
-                                             "Content-Type": "application/x-www-form-urlencoded"})
-
-        limit = 50
-        new_results = True
-        offset = 0
-
-        with dbm.open(settings.uptime_monitors_mapping_db, 'c') as db:
-            while new_results:
-                payload = f'api_key={self.uptimerobot_api_key}&format=json&logs=0&offset={offset}&limit={limit}'
-                logger.debug(payload)
-                response = httpx_client.post('https://api.uptimerobot.com/v2/getMonitors', data=payload)
-                data = response.json()
-                if data["stat"] == "fail":
-                    raise Exception(data["error"]["message"])
-                total = data['pagination']['total']
-                for monitor in data['monitors']:
-                    monitor_id = monitor['id']
+        """Rebuilds the PID Graph ID -> monitor id mapping from all monitors, saves it as a snapshot and swaps it in.
+        The first page gives the total: the other pages are fetched concurrently (UPTIMEROBOT_MAX_CONCURRENT_PAGES)."""
+        with _mapping_rebuild_lock:
+            first = self._get_monitors(offset=0, limit=self.page_limit)
+            total = first['pagination']['total']
+            offsets = range(self.page_limit, total, self.page_limit)
+            with ThreadPoolExecutor(max_workers=settings.UPTIMEROBOT_MAX_CONCURRENT_PAGES) as pool:
+                pages = [first, *pool.map(lambda offset: self._get_monitors(offset=offset, limit=self.page_limit), offsets)]
+            mapping = {}
+            for page in pages:
+                for monitor in page['monitors']:
                     friendly_name_field = monitor['friendly_name'].split(';', 1)
-                    pid_graph_id = friendly_name_field[1].strip()
-                    logger.debug(pid_graph_id + " (" + friendly_name_field[0].strip() + ") " + str(monitor_id))
-                    db[pid_graph_id] = str(monitor_id)
-                offset += limit
-                new_results = total > offset
-            httpx_client.close()
-            logger.info(f"UptimeRobot monitors mapping updated. Total monitors: {total}")
-            for k in db.keys():
-                logger.info(f'"{k.decode('utf-8')}" :  "{db[k].decode('utf-8')}"')
+                    mapping[friendly_name_field[1].strip()] = str(monitor['id'])
+            save_mapping_snapshot(mapping)
+            set_monitors_mapping(mapping)
+        logger.info("UptimeRobot monitors mapping updated. Total monitors: %s", total)
         return total
 
-    def get_monitors_uptime_by_pidgraph_ids(self, pidgraph_ids: str) -> str:
+    def get_monitors_uptime_by_pidgraph_ids(self, pidgraph_ids: str) -> dict:
+        mapping = get_monitors_mapping()
         monitor_ids = []
-        with dbm.open(settings.uptime_monitors_mapping_db, 'r') as db:
-            for pidgraph_id in pidgraph_ids.split('-'):
-                try:
-                    monitor_ids.append(db[pidgraph_id].decode('utf-8'))
-                except KeyError:
-                    logger.error(f"PID Graph ID not found in UptimeRobot mapping: {pidgraph_id}")
-                    continue
+        for pidgraph_id in pidgraph_ids.split('-'):
+            monitor_id = mapping.get(pidgraph_id)
+            if monitor_id is None:
+                logger.error("PID Graph ID not found in UptimeRobot mapping: %s", pidgraph_id)
+                continue
+            monitor_ids.append(monitor_id)
         return self.get_monitors_mean_uptime(monitor_ids)
 
-    def get_monitors_mean_uptime(self, monitor_ids: List[str]) -> str:
-        httpx_client = httpx.Client(headers={"user-agent": settings.PIDRESOLVER_USER_AGENT,
-                                             "Content-Type": "application/x-www-form-urlencoded"})
+    def get_monitors_mean_uptime(self, monitor_ids: List[str]) -> dict:
+        """The mean uptime of the monitors over the last year, computed from the cached uptime of each monitor."""
+        monitors = monitor_uptimes.get(monitor_ids)
+        if not monitors:
+            raise Exception(f"No UptimeRobot monitors found: {'-'.join(monitor_ids)}")
 
         now = datetime.datetime.now()
-        oneyearago = now - relativedelta(years=1)
-        days_in_last_year = (now - oneyearago).days
-
-        time_range = f'{int(oneyearago.timestamp())}_{int(now.timestamp())}'
-        payload = f'api_key={self.uptimerobot_api_key}&format=json&logs=0&monitors={"-".join(monitor_ids)}&custom_uptime_ranges={time_range}'
-        logger.debug(payload)
-        response = httpx_client.post('https://api.uptimerobot.com/v2/getMonitors', data=payload)
-        data = response.json()
-        httpx_client.close()
-
-        if data["stat"] == "fail":
-            raise Exception(data["error"]["message"])
-
-        uptime_ranges = [float(monitor['custom_uptime_ranges']) for monitor in data['monitors']]
-        mean_uptime = sum(uptime_ranges) / len(uptime_ranges)
+        days_in_last_year = (now - (now - relativedelta(years=1))).days
+        mean_uptime = sum(float(monitor["uptime"]) for monitor in monitors) / len(monitors)
         downtime_days = (1 - (mean_uptime / 100)) * days_in_last_year
+        starts, ends = zip(*(monitor["timestamp_interval"].split("_") for monitor in monitors))
 
-        # Create response JSON:
-        transformed_monitors = []
-        for monitor in data['monitors']:
-            friendly_name_field = monitor['friendly_name'].split(';', 1)
-            transformed_monitor = {
-                "id": monitor["id"],
-                "pid_graph_id": friendly_name_field[1].strip(),
-                "friendly_name": friendly_name_field[0].strip(),
-                "url": monitor["url"],
-                "uptime": monitor["custom_uptime_ranges"]
-            }
-            transformed_monitors.append(transformed_monitor)
-        transformed_data = {
-            "stat": data["stat"],
+        return {
+            "stat": "ok",
             "mean_uptime": round(mean_uptime, 3),
             "days_downtime": round(downtime_days, 4),
-            "timestamp_interval": time_range,
-            "monitors": transformed_monitors
+            "timestamp_interval": f"{min(starts)}_{max(ends)}",
+            "monitors": monitors
         }
-        return json.dumps(transformed_data, indent=4)
+
+    def fetch_monitors_uptime(self, monitor_ids: List[str]) -> dict[str, Optional[dict]]:
+        """Fetches the uptime over the last year of the monitors, page_limit monitors per request.
+        Returns monitor id -> monitor, or None for an unknown monitor id."""
+        now = datetime.datetime.now()
+        oneyearago = now - relativedelta(years=1)
+        time_range = f'{int(oneyearago.timestamp())}_{int(now.timestamp())}'
+        monitors: dict[str, Optional[dict]] = dict.fromkeys(monitor_ids)
+        for i in range(0, len(monitor_ids), self.page_limit):
+            data = self._get_monitors(monitors="-".join(monitor_ids[i:i + self.page_limit]),
+                                      custom_uptime_ranges=time_range)
+            for monitor in data['monitors']:
+                friendly_name_field = monitor['friendly_name'].split(';', 1)
+                monitors[str(monitor["id"])] = {
+                    "id": monitor["id"],
+                    "pid_graph_id": friendly_name_field[1].strip(),
+                    "friendly_name": friendly_name_field[0].strip(),
+                    "url": monitor["url"],
+                    "uptime": monitor["custom_uptime_ranges"],
+                    "timestamp_interval": time_range
+                }
+        return monitors
+
+
+monitor_uptimes = MonitorUptimeCache(UptimeRobot().fetch_monitors_uptime,
+                                     refresh_interval=settings.UPTIMEROBOT_REFRESH_INTERVAL)
 
 
 if __name__ == "__main__":
     uptimerobo = UptimeRobot()
     uptimerobo.update_monitors_mapping()
-
-    db = dbm.open(settings.uptime_monitors_mapping_db, 'r')
-    for key in db.keys():
-        value = db[key]
-        print(f'"{key.decode('utf-8')}" :  "{value.decode('utf-8')}"')
-    db.close()
-
-
-        # jsonpath_expr = parse('$.mean_uptime')
-        # # Find the mean_uptime
-        # mean_uptime = [match.value for match in jsonpath_expr.find(data)][0]
+    for pidgraph_id, monitor_id in get_monitors_mapping().items():
+        print(f'"{pidgraph_id}" :  "{monitor_id}"')
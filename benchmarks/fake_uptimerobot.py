@@ -0,0 +1,138 @@
+"""Local fake of the UptimeRobot API (v2): POST /v2/getMonitors. Run the API (api/uptimerobot.py) against it without an
+UptimeRobot account, e.g. to try the mapping refresh, the uptime cache or an outage, and to benchmark them.
+Serves `count` monitors, named "<name>; pid_graph:<8 hex digits>", with pagination (offset, limit <= 50), the
+`monitors` (ids separated by "-") filter and `custom_uptime_ranges`. Requests are counted per method.
+
+    python -m benchmarks.fake_uptimerobot --monitors 1000
+    UPTIMEROBOT_API_URL=http://127.0.0.1:18090/v2  (DYNACONF_UPTIMEROBOT_API_URL, for the application)
+
+An outage is simulated with FakeUptimeRobot.set_outage(True): requests get a 503 response.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import multiprocessing.managers
+from typing import Optional
+from urllib.parse import parse_qs
+
+from benchmarks.stub_resolvers import _response
+
+PAGE_LIMIT = 50
+
+
+def _monitor(i: int) -> dict:
+    return {"id": 790000000 + i, "friendly_name": f"Monitor {i}; pid_graph:{i:08X}", "url": f"https://example.org/{i}",
+            "type": 1, "status": 2}
+
+
+def _uptime(monitor_id: int) -> str:
+    return f"{99 + (monitor_id % 1000) / 1000:.3f}"
+
+
+def _get_monitors(params: dict, count: int) -> dict:
+    offset, limit = int(params.get("offset", 0)), min(int(params.get("limit", PAGE_LIMIT)), PAGE_LIMIT)
+    if params.get("monitors"):
+        ids = [int(monitor_id) - 790000000 for monitor_id in params["monitors"].split("-") if monitor_id.isdigit()]
+        selected = [i for i in ids if 0 <= i < count]
+    else:
+        selected = list(range(count))
+    page = [_monitor(i) for i in selected[offset:offset + limit]]
+    if params.get("custom_uptime_ranges"):
+        for monitor in page:
+            monitor["custom_uptime_ranges"] = _uptime(monitor["id"])
+    return {"stat": "ok", "pagination": {"offset": offset, "limit": limit, "total": len(selected)}, "monitors": page}
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter, count: int, state) -> None:
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            length = 0
+            while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                name, _, value = line.decode("latin-1").partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            body = (await reader.readexactly(length)).decode() if length else ""
+            path = request_line.decode("latin-1").split(" ")[1]
+            method = path.rstrip("/").rsplit("/", 1)[-1]
+            state[method] = state.get(method, 0) + 1
+            params = {key: values[0] for key, values in parse_qs(body).items()}
+            if state.get("outage"):
+                writer.write(_response("503 Service Unavailable", {}))
+            elif method != "getMonitors":
+                writer.write(_response("404 Not Found", {}))
+            elif not params.get("api_key"):
+                writer.write(_response("200 OK", {"Content-Type": "application/json"}, json.dumps(
+                    {"stat": "fail", "error": {"type": "missing_parameter", "message": "api_key is missing."}}).encode()))
+            else:
+                writer.write(_response("200 OK", {}, json.dumps(_get_monitors(params, count)).encode()))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _serve(port: int, count: int, state, ready) -> None:
+    server = await asyncio.start_server(lambda r, w: _handle(r, w, count, state), "127.0.0.1", port)
+    ready.set()
+    await server.serve_forever()
+
+
+def _run(port: int, count: int, state, ready) -> None:
+    asyncio.run(_serve(port, count, state, ready))
+
+
+class FakeUptimeRobot:
+    """Runs the fake API in a separate process. `requests(method)` is the number of requests received."""
+
+    def __init__(self, monitors: int = 100, port: int = 18090):
+        self.monitors = monitors
+        self.port = port
+        self._manager: Optional[multiprocessing.managers.SyncManager] = None
+        self._process: Optional[multiprocessing.Process] = None
+
+    @property
+    def api_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}/v2"
+
+    def pid_graph_id(self, i: int) -> str:
+        return f"pid_graph:{i:08X}"
+
+    def requests(self, method: str = "getMonitors") -> int:
+        return self._state.get(method, 0)
+
+    def set_outage(self, outage: bool) -> None:
+        self._state["outage"] = outage
+
+    def __enter__(self) -> "FakeUptimeRobot":
+        self._manager = multiprocessing.Manager()
+        self._state = self._manager.dict()
+        ready = multiprocessing.Event()
+        self._process = multiprocessing.Process(target=_run, args=(self.port, self.monitors, self._state, ready),
+                                                daemon=True)
+        self._process.start()
+        if not ready.wait(30):
+            raise RuntimeError("Fake UptimeRobot API did not start.")
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._process.terminate()
+        self._process.join()
+        self._manager.shutdown()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local fake of the UptimeRobot API.")
+    parser.add_argument("--monitors", type=int, default=100)
+    parser.add_argument("--port", type=int, default=18090)
+    args = parser.parse_args()
+    with FakeUptimeRobot(args.monitors, args.port) as fake:
+        print(f"Fake UptimeRobot API at {fake.api_url} with {args.monitors} monitors. Ctrl-C to stop.")
+        try:
+            fake._process.join()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,232 @@
+"""Offline benchmark of the resolver and the task layer, against the local stub resolver farm (stub_resolvers.py).
+
+    python -m benchmarks.run_benchmark --mode engine --pids 5000
+    python -m benchmarks.run_benchmark --mode sync --pids 500 --concurrency 10
+    python -m benchmarks.run_benchmark --mode celery --pids 5000 --workers 4   (needs POSTGRES_CONNECTION_STRING)
+    python -m benchmarks.run_benchmark --mode db --pids 100000                 (needs POSTGRES_CONNECTION_STRING)
+    python -m benchmarks.run_benchmark --mode uptime --pids 2000 --monitors 5000
+
+engine: pidresolver.resolve_pids; sync: pidresolver.resolve_url_by_pid from a thread pool; celery: resolve_pid_chunk_task
+on an in-process worker with an in-memory broker; db: the write-behind writer of pid_resolution records; uptime: the
+UptimeRobot mapping rebuild, then `--pids` mean uptime requests (5 PID Graph IDs each) from a thread pool, against the
+fake UptimeRobot API (fake_uptimerobot.py).
+Prints one JSON line: PIDs/sec, p50/p99 latency (ms) and the peak memory (RSS) of the (worker) process.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from benchmarks.fake_uptimerobot import FakeUptimeRobot
+from benchmarks.stub_resolvers import StubResolverFarm
+
+# PID "kinds", by the stub resolver route that imitates them.
+KINDS = {
+    "doi": lambda farm, i: f"{farm.http_url}/doi/3/{i}",  # resolver -> resolver -> landing page
+    "handle": lambda farm, i: f"{farm.http_url}/doi/1/{i}",
+    "slow": lambda farm, i: f"{farm.http_url}/slow/500/{i}",
+    "large": lambda farm, i: f"{farm.http_url}/large/2048/{i}",
+    "tls": lambda farm, i: f"{farm.https_url}/doi/2/{i}",  # self-signed certificate
+    "reset": lambda farm, i: f"{farm.http_url}/reset/{i}",
+    "timeout": lambda farm, i: f"{farm.http_url}/timeout/{i}",
+}
+DEFAULT_MIX = "doi=70,handle=15,slow=5,large=4,tls=4,reset=1,timeout=1"
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="PID resolution benchmark against local stub resolvers.")
+    parser.add_argument("--mode", choices=("engine", "sync", "celery", "db", "uptime"), default="engine")
+    parser.add_argument("--pids", type=int, default=2000)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"PID kinds and their weights, default: {DEFAULT_MIX}")
+    parser.add_argument("--concurrency", type=int, default=50, help="PIDs in flight (engine, celery) or threads (sync)")
+    parser.add_argument("--workers", type=int, default=4, help="Celery worker threads (celery)")
+    parser.add_argument("--chunk-size", type=int, default=100, help="PIDs per chunk task (celery)")
+    parser.add_argument("--timeout", type=float, default=2.0, help="Resolver connect/read timeout in seconds")
+    parser.add_argument("--host-rate", type=float, default=0, help="Per-host requests/second (per process), 0 = unlimited")
+    parser.add_argument("--monitors", type=int, default=1000, help="Monitors of the fake UptimeRobot API (uptime)")
+    parser.add_argument("--uptimerobot-port", type=int, default=18090, help="Port of the fake UptimeRobot API (uptime)")
+    parser.add_argument("--seed", type=int, default=42)
+    return parser.parse_args()
+
+
+def configure(args: argparse.Namespace) -> None:
+    """Settings for the benchmark: must be set before the application modules (and settings) are loaded."""
+    os.environ.setdefault("BASE_DIR", os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault("JWT_SECRET_KEY", "benchmark")
+    os.environ["DYNACONF_PIDRESOLVER_TIMEOUT"] = str(args.timeout)
+    os.environ["DYNACONF_PIDRESOLVER_READ_TIMEOUT"] = str(args.timeout)
+    os.environ["DYNACONF_PIDRESOLVER_CONCURRENCY"] = str(args.concurrency)
+    os.environ["DYNACONF_PIDRESOLVER_HOST_RATE"] = str(args.host_rate)
+    os.environ["DYNACONF_PIDRESOLVER_HOST_MAX_IN_FLIGHT"] = str(max(args.concurrency, args.workers * args.concurrency))
+    os.environ["DYNACONF_PIDRESOLVER_HOST_LIMIT_SHARES"] = "1"  # the limits above are per process
+    os.environ["DYNACONF_CELERY_CHUNK_SIZE"] = str(args.chunk_size)
+    os.environ["DYNACONF_PIDRESOLVER_CIRCUIT_THRESHOLD"] = "0"  # All stub resolvers share one host.
+    os.environ.setdefault("UPTIMEROBOT_API_KEY", "benchmark")
+    os.environ["DYNACONF_UPTIMEROBOT_API_URL"] = FakeUptimeRobot(port=args.uptimerobot_port).api_url
+    os.environ["DYNACONF_UPTIME_MONITORS_MAPPING_FILE"] = os.path.join(tempfile.mkdtemp(), "mapping.json")
+    import logging
+    import logging_config  # sets the levels of the loggers in settings.LOGGERS: only override them after that
+    for logger in (logging_config.prm_logger, logging_config.pidmr_logger):
+        logger.setLevel(logging.WARNING)
+
+
+def generate_pids(farm: StubResolverFarm, mix: str, count: int, seed: int) -> list[str]:
+    weights = {kind: float(weight) for kind, weight in (item.split("=") for item in mix.split(","))}
+    kinds = random.Random(seed).choices(list(weights), weights=list(weights.values()), k=count)
+    return [KINDS[kind](farm, i) for i, kind in enumerate(kinds)]
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+
+def bench_engine(pids: list[str], concurrency: int) -> tuple[list[float], int]:
+    from api import pidresolver
+    started: dict[str, float] = {}
+
+    def timed(pids_):
+        for pid in pids_:
+            started[pid] = time.perf_counter()
+            yield pid
+
+    async def run():
+        latencies, errors = [], 0
+        async for record in pidresolver.resolve_pids(timed(pids), concurrency=concurrency):
+            latencies.append(time.perf_counter() - started[record.pid_id])
+            errors += record.http_error is not None
+        return latencies, errors
+
+    return asyncio.run(run())
+
+
+def bench_sync(pids: list[str], concurrency: int) -> tuple[list[float], int]:
+    from api import pidresolver
+
+    def resolve(pid):
+        start = time.perf_counter()
+        try:
+            pidresolver.resolve_url_by_pid(pid)
+            return time.perf_counter() - start, False
+        except Exception:
+            return time.perf_counter() - start, True
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(resolve, pids))
+    return [latency for latency, _ in results], sum(error for _, error in results)
+
+
+def bench_celery(pids: list[str], workers: int, chunk_size: int) -> tuple[list[float], int]:
+    from celery.contrib.testing.worker import start_worker
+    from celeryworker.utils import get_celery
+    from database import models
+    from database.database import engine
+
+    models.Base.metadata.create_all(bind=engine)
+    app = get_celery()
+    app.conf.update(broker_url="memory://", result_backend="cache+memory://", beat_schedule={},
+                    broker_transport_options={"polling_interval": 0.01})
+    from celeryworker.tasks import resolve_pid_chunk_task
+
+    latencies, errors = [], 0
+    with start_worker(app, pool="threads", concurrency=workers, perform_ping_check=False, loglevel="WARNING"):
+        chunks = [pids[i:i + chunk_size] for i in range(0, len(pids), chunk_size)]
+        start = time.perf_counter()
+        results = [resolve_pid_chunk_task.apply_async(args=[chunk], ignore_result=False) for chunk in chunks]
+        for result in results:
+            per_pid = result.get(timeout=3600)
+            latency = time.perf_counter() - start  # a PID is done when its chunk is done
+            latencies.extend([latency] * len(per_pid))
+            errors += sum(not isinstance(status, int) for status in per_pid.values())
+    return latencies, errors
+
+
+def bench_db(count: int) -> tuple[list[float], int]:
+    from api.pidresolver import ResolutionRecord
+    from database import models
+    from database.database import engine
+    from database.writer import monitor_record_writer
+
+    models.Base.metadata.create_all(bind=engine)
+    latencies = []
+    batch_size = monitor_record_writer.max_size
+    for i in range(0, count, batch_size):
+        start = time.perf_counter()
+        for j in range(i, min(i + batch_size, count)):
+            monitor_record_writer.add(ResolutionRecord(
+                time_stamp=datetime.now(), pid_id=f"benchmark:{j}", pid_url=f"https://doi.org/10.1234/{j}",
+                status_code=200, ssl_verified=True, redirect_count=2, resolution_url=f"https://example.org/{j}",
+                http_error=None))
+        monitor_record_writer.flush()  # if the batch did not fill (and flush) the buffer
+        latencies.append(time.perf_counter() - start)  # per batch
+    return latencies, 0
+
+
+def bench_uptime(requests: int, monitors: int, concurrency: int, seed: int) -> tuple[list[float], int]:
+    from api.uptimerobot import UptimeRobot
+
+    uptimerobot = UptimeRobot()
+    uptimerobot.update_monitors_mapping()
+    rng = random.Random(seed)
+    pidgraph_ids = ["-".join(f"pid_graph:{rng.randrange(monitors):08X}" for _ in range(5)) for _ in range(requests)]
+
+    def request(ids: str) -> tuple[float, int]:
+        start = time.perf_counter()
+        try:
+            uptimerobot.get_monitors_uptime_by_pidgraph_ids(ids)
+            return time.perf_counter() - start, 0
+        except Exception:
+            return time.perf_counter() - start, 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(request, pidgraph_ids))
+    return [latency for latency, _ in results], sum(error for _, error in results)
+
+
+def main() -> None:
+    args = parse_args()
+    configure(args)
+    if args.mode == "uptime":
+        with FakeUptimeRobot(args.monitors, args.uptimerobot_port):
+            start = time.perf_counter()
+            latencies, errors = bench_uptime(args.pids, args.monitors, args.concurrency, args.seed)
+            seconds = time.perf_counter() - start
+    else:
+        latencies, errors, seconds = bench_resolution(args)
+    report = {
+        "mode": args.mode,
+        "pids": args.pids,
+        "seconds": round(seconds, 3),
+        "pids_per_sec": round(args.pids / seconds, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 1),
+        "errors": errors,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    print(json.dumps(report))
+
+
+def bench_resolution(args: argparse.Namespace) -> tuple[list[float], int, float]:
+    with StubResolverFarm() as farm:
+        pids = generate_pids(farm, args.mix, args.pids, args.seed)
+        start = time.perf_counter()
+        if args.mode == "engine":
+            latencies, errors = bench_engine(pids, args.concurrency)
+        elif args.mode == "sync":
+            latencies, errors = bench_sync(pids, args.concurrency)
+        elif args.mode == "celery":
+            latencies, errors = bench_celery(pids, args.workers, args.chunk_size)
+        else:
+            latencies, errors = bench_db(args.pids)
+        return latencies, errors, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    sys.exit(main())
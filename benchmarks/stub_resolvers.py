@@ -0,0 +1,132 @@
+"""Local stub resolver farm for the benchmarks: a minimal asyncio HTTP/1.1 (keep-alive) server, also served over TLS
+with a self-signed certificate. It imitates doi.org- and handle-style resolvers and landing pages:
+
+    /doi/<hops>/<id>       redirect chain of <hops> 302s (resolver -> ... -> /landing/<id>)
+    /slow/<ms>/<id>        first byte after <ms> milliseconds, then redirects to the landing page
+    /large/<kb>/<id>       landing page of <kb> kilobytes
+    /reset/<id>            connection reset, without a response
+    /timeout/<id>          no response at all (the client times out)
+    /landing/<id>          small landing page
+"""
+import asyncio
+import multiprocessing
+import os
+import socket
+import ssl
+import struct
+import subprocess
+import tempfile
+from typing import Optional
+
+_LANDING_PAGE = b"<html><head><title>Landing page</title></head><body>" + b"x" * 2048 + b"</body></html>"
+
+
+def _response(status: str, headers: dict, body: bytes = b"") -> bytes:
+    head = [f"HTTP/1.1 {status}", f"Content-Length: {len(body)}", "Content-Type: text/html"]
+    head += [f"{name}: {value}" for name, value in headers.items()]
+    return ("\r\n".join(head) + "\r\n\r\n").encode() + body
+
+
+async def _handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                return
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # headers are not used
+            method, path = request_line.decode("latin-1").split(" ")[:2]
+            parts = path.strip("/").split("/")
+            route = parts[0]
+            if route == "doi":
+                hops = int(parts[1])
+                location = f"/doi/{hops - 1}/{parts[2]}" if hops > 1 else f"/landing/{parts[2]}"
+                writer.write(_response("302 Found", {"Location": location}))
+            elif route == "slow":
+                await asyncio.sleep(int(parts[1]) / 1000)
+                writer.write(_response("302 Found", {"Location": f"/landing/{parts[2]}"}))
+            elif route == "large":
+                body = b"x" * (int(parts[1]) * 1024)
+                writer.write(_response("200 OK", {}, b"" if method == "HEAD" else body))
+            elif route == "reset":
+                sock = writer.get_extra_info("socket")
+                if sock is not None:
+                    sock.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+                writer.transport.abort()
+                return
+            elif route == "timeout":
+                await asyncio.sleep(3600)
+            elif route == "landing":
+                writer.write(_response("200 OK", {}, b"" if method == "HEAD" else _LANDING_PAGE))
+            else:
+                writer.write(_response("404 Not Found", {}))
+            await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError, ValueError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+
+def _self_signed_context(directory: str) -> Optional[ssl.SSLContext]:
+    """Creates a self-signed certificate with the openssl CLI. Returns None if openssl is not available."""
+    cert, key = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    try:
+        subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1", "-subj", "/CN=localhost",
+                        "-keyout", key, "-out", cert], check=True, capture_output=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+async def _serve(http_port: int, https_port: int, ready) -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        servers = [await asyncio.start_server(_handle, "127.0.0.1", http_port, backlog=1024)]
+        context = _self_signed_context(directory)
+        if context:
+            servers.append(await asyncio.start_server(_handle, "127.0.0.1", https_port, ssl=context, backlog=1024))
+        ready.set()
+        await asyncio.gather(*(server.serve_forever() for server in servers))
+
+
+def _run(http_port: int, https_port: int, ready) -> None:
+    asyncio.run(_serve(http_port, https_port, ready))
+
+
+class StubResolverFarm:
+    """Runs the stub servers in a separate process, so they do not compete with the benchmarked code for the GIL."""
+
+    def __init__(self, http_port: int = 18080, https_port: int = 18443):
+        self.http_port = http_port
+        self.https_port = https_port
+        self._process: Optional[multiprocessing.Process] = None
+
+    @property
+    def http_url(self) -> str:
+        return f"http://127.0.0.1:{self.http_port}"
+
+    @property
+    def https_url(self) -> str:
+        return f"https://127.0.0.1:{self.https_port}"
+
+    def __enter__(self) -> "StubResolverFarm":
+        ready = multiprocessing.Event()
+        self._process = multiprocessing.Process(target=_run, args=(self.http_port, self.https_port, ready), daemon=True)
+        self._process.start()
+        if not ready.wait(30):
+            raise RuntimeError("Stub resolver farm did not start.")
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self._process.terminate()
+        self._process.join()
+
+
+if __name__ == "__main__":
+    with StubResolverFarm() as farm:
+        print(f"Stub resolvers at {farm.http_url} and {farm.https_url}. Ctrl-C to stop.")
+        try:
+            farm._process.join()
+        except KeyboardInterrupt:
+            pass
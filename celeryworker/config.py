@@ -3,6 +3,8 @@ from functools import lru_cache
 
 from kombu import Queue
 
+from settings import settings as prm_settings
+
 
 def route_task(name, args, kwargs, options, task=None, **kw):
     """Routes/maps a task to a certain queue by its (task)name"""
@@ -29,6 +31,22 @@ class BaseConfig:
 
     CELERY_TASK_ROUTES = (route_task,)
 
+    # Periodic tasks, scheduled by one `celery beat` process (not one per worker, see run.sh):
+    CELERY_BEAT_SCHEDULE: dict = {
+        "dispatch-pid-retries": {
+            "task": "celery:dispatch_pid_retries_task",
+            "schedule": prm_settings.PID_RETRY_DISPATCH_INTERVAL,
+        },
+        "schedule-pid-rechecks": {
+            "task": "celery:schedule_pid_rechecks_task",
+            "schedule": prm_settings.PID_RECHECK_TICK,
+        },
+        "maintain-pid-resolution": {
+            "task": "celery:maintain_pid_resolution_task",
+            "schedule": prm_settings.PID_RESOLUTION_MAINTENANCE_INTERVAL,
+        },
+    }
+
 
 class DevelopmentConfig(BaseConfig):
     pass
@@ -1,13 +1,27 @@
 import random
 import httpx
 
-from datetime import datetime, timedelta, timezone
-from typing import List
+from datetime import datetime
+from typing import Iterable, List
 from celery import shared_task, Task
+from celery.signals import worker_init, worker_process_shutdown, worker_shutdown
 from api import pidresolver, pidmr
-from database.crud import save_pid_resolution_record
-from logging_config import prm_logger as logger
+from database.crud import save_pid_resolution_records, schedule_pid_retries, clear_pid_retries, claim_due_pid_retries, \
+    select_pid_rechecks
+from database.retention import maintain_pid_resolution
+from database.writer import monitor_record_writer
+from logging_config import prm_logger as logger, stop_listeners
 from schemas.schemas import PIDMResolutionEvent
+from settings import settings
+from utils.cache import TTLCache
+from utils.eventloop import run_sync
+from .utils import get_celery
+
+# The app of the tasks, configured wherever they are imported: the worker (celery -A main.celery) and the API.
+celery_app = get_celery()
+
+# PIDs that were enqueued for resolution recently, see request_pid_resolution().
+recent_resolution_requests = TTLCache(max_size=settings.PIDRESOLVER_CACHE_SIZE, ttl=settings.PIDRESOLVER_CACHE_TTL)
 
 
 @shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={"max_retries": 1},
@@ -17,43 +31,181 @@ def save_pidmr_event_task(self, event: PIDMResolutionEvent):
     return store_result
 
 
+@worker_init.connect
+def warm_up_worker(**kwargs):
+    """Imports what the API defers to first use, before the pool forks: the worker processes inherit it."""
+    pidresolver.warm_up()
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def flush_resolution_records(**kwargs):
+    """Writes the buffered resolution records, and the queued log records, before the worker (process) exits."""
+    monitor_record_writer.flush()
+    logger.info("Resolution cache statistics: %s", pidresolver.get_resolution_cache_stats())
+    stop_listeners()
+
+
+def _failure_record(pid: str, error: str) -> pidresolver.ResolutionRecord:
+    return pidresolver.create_resolution_record(
+        pid,
+        pidresolver.get_actionable_pid_url(pid),
+        None,
+        False,
+        error
+    )
+
+
+def _observation(record: pidresolver.ResolutionRecord) -> pidresolver.ResolutionRecord:
+    """The record to save for a resolution. A cached result (of a recent or concurrent resolution of the same actionable
+    URL, maybe under another form of the PID) is an observation of this PID now: it extends its run and its re-check."""
+    return record.model_copy(update={"time_stamp": datetime.now()}) if record.cached else record
+
+
 class BaseResolutionTask(Task):
     def on_failure(self, exc, task_id, args, kwargs, einfo):
-        rr = pidresolver.create_resolution_record(
-            args[0],
-            pidresolver.get_actionable_pid_url(args[0]),
-            None,
-            False,
-            str(exc)
-        )
-        save_pid_resolution_record(record=rr)
-        logger.warn(f"'{args[0]}' unresolvable after {self.request.retries}/{self.max_retries} retries. Error: {exc}")
+        monitor_record_writer.add(_failure_record(args[0], str(exc)))
+        logger.warning("'%s' unresolvable. Error: %s", args[0], exc)
 
     def on_success(self, retval, task_id, args, kwargs):
-        logger.info(f'Task {task_id} succeeded: {retval.pid_url} => {retval.resolution_url} (HTTP {retval.status_code})')
+        if retval is None:
+            return
+        logger.info("Task %s succeeded: %s => %s (HTTP %s)", task_id, retval.pid_url, retval.resolution_url,
+                    retval.status_code, extra={"event": "pid_resolved"})
 
 
-@shared_task(bind=True, autoretry_for=(httpx.HTTPError,), name='pid-resolution:resolve_pid_task',
-             base=BaseResolutionTask, ignore_result=True,
-             throws=(httpx.HTTPError,), max_retries=1)
+@shared_task(bind=True, name='pid-resolution:resolve_pid_task', base=BaseResolutionTask, ignore_result=True)
 def resolve_pid_task(self, pid: str):
     try:
-        logger.info(f"Starting PID resolution TASK for: {pid} ({self.request.retries}/{self.max_retries})")
+        logger.info("Starting PID resolution TASK for: %s", pid, extra={"event": "pid_resolution_started"})
         resolution_record = pidresolver.resolve_url_by_pid(pid)
-        save_pid_resolution_record(record=resolution_record)
+        if resolution_record:
+            monitor_record_writer.add(_observation(resolution_record))
         return resolution_record
     except httpx.HTTPError as e:
-        logger.debug(f"PID {pid} resolution failed. retries: {self.request.retries}/{self.max_retries}, Error: {e}.")
-        base_eta = datetime.now(timezone.utc) + timedelta(hours=24)
-        jitter_seconds = random.randint(-3600, 3600)
-        jittered_eta = base_eta + timedelta(seconds=jitter_seconds)
-        raise self.retry(exc=e, queue='celery', max_retries=1, eta=jittered_eta)
+        logger.debug("PID %s resolution failed. Error: %s.", pid, e, extra={"event": "pid_resolution_failed"})
+        schedule_retries({pid: str(e)})
+
+
+def schedule_retries(failures: dict[str, str]) -> None:
+    """Schedules a durable retry (pid_resolution_retry table) for each failed PID (pid -> error), PIDRESOLVER_RETRY_DELAY
+    ± PIDRESOLVER_RETRY_JITTER seconds from now. The failure of a PID without retries left is recorded."""
+    exhausted = schedule_pid_retries(failures, max_retries=settings.PIDRESOLVER_MAX_RETRIES,
+                                     delay=settings.PIDRESOLVER_RETRY_DELAY, jitter=settings.PIDRESOLVER_RETRY_JITTER)
+    for pid in exhausted:
+        monitor_record_writer.add(_failure_record(pid, failures[pid]))
+        logger.warning("'%s' unresolvable after %s retries. Error: %s", pid, settings.PIDRESOLVER_MAX_RETRIES,
+                       failures[pid])
+
+
+@shared_task(name='celery:dispatch_pid_retries_task', ignore_result=True)
+def dispatch_pid_retries_task() -> int:
+    """Periodic (Celery beat) task: enqueues the retries that are due, in chunks, spread over the dispatch interval.
+    Retries wait in Postgres until they are due, instead of as ETA messages in the worker's memory."""
+    dispatched = 0
+    while dispatched < settings.PID_RETRY_DISPATCH_MAX:
+        pids = claim_due_pid_retries(limit=settings.CELERY_CHUNK_SIZE, lease=settings.PID_RETRY_LEASE)
+        if not pids:
+            break
+        resolve_pid_chunk_task.apply_async(args=[pids], kwargs={"retry": True},
+                                           countdown=random.uniform(0, settings.PID_RETRY_DISPATCH_INTERVAL))
+        dispatched += len(pids)
+    if dispatched:
+        logger.info("Dispatched %s due PID resolution retries.", dispatched)
+    return dispatched
+
+
+@shared_task(name='celery:schedule_pid_rechecks_task', ignore_result=True)
+def schedule_pid_rechecks_task() -> None:
+    """Periodic (Celery beat) task, every PID_RECHECK_TICK seconds: fans out the re-check of the known PID corpus over
+    PID_RECHECK_SHARDS shard tasks, which run on any worker."""
+    for shard in range(settings.PID_RECHECK_SHARDS):
+        recheck_pid_shard_task.delay(shard)
+
+
+@shared_task(name='celery:recheck_pid_shard_task', ignore_result=True)
+def recheck_pid_shard_task(shard: int) -> int:
+    """Enqueues this tick's share of the re-checks of a shard of the PID corpus: its size * tick / PID_RECHECK_WINDOW
+    PIDs, so the whole corpus is re-checked once per window at a flat rate. The PIDs that are due the longest (the
+    stalest and previously failing ones) go first. The chunks are spread evenly over the tick."""
+    tick = settings.PID_RECHECK_TICK
+    total, pids = select_pid_rechecks(shard, settings.PID_RECHECK_SHARDS, share=tick / settings.PID_RECHECK_WINDOW,
+                                      limit=settings.PID_RECHECK_MAX_PER_TICK)
+    chunk_size = settings.CELERY_CHUNK_SIZE
+    chunks = [pids[i:i + chunk_size] for i in range(0, len(pids), chunk_size)]
+    for i, chunk in enumerate(chunks):
+        resolve_pid_chunk_task.apply_async(args=[chunk], countdown=i * tick / len(chunks))
+    logger.info("Re-check shard %s: %s of %s PIDs enqueued in %s chunks.", shard, len(pids), total, len(chunks))
+    return len(pids)
+
+
+@shared_task(name='celery:maintain_pid_resolution_task', ignore_result=True)
+def maintain_pid_resolution_task() -> dict:
+    """Periodic (Celery beat) task, every PID_RESOLUTION_MAINTENANCE_INTERVAL seconds: creates the pid_resolution
+    partitions ahead, rolls up the completed days and drops the expired partitions."""
+    return maintain_pid_resolution()
+
+
+@shared_task(bind=True, name='pid-resolution:resolve_pid_chunk_task', ignore_result=True)
+def resolve_pid_chunk_task(self, pids: List[str], retry: bool = False) -> dict:
+    """Resolves a chunk of PIDs (one broker message) concurrently within the worker."""
+    return resolve_and_save_pids(pids, retry)
 
 
 @shared_task(bind=True, autoretry_for=(Exception,), retry_backoff=True, retry_kwargs={"max_retries": 1},
              name='pid-resolution:resolve_all_pids_task')
 def resolve_all_pids_task(self, pides: List[str]):
-    data: dict = {}
-    for pidx in pides:
-        data.update(pidresolver.resolve_url_by_pid(pidx))
-    return data
+    return resolve_and_save_pids(pides)
+
+
+def request_pid_resolution(pid: str) -> bool:
+    """Enqueues a resolve_pid_task for the PID, unless it was enqueued (by this process) less than PIDRESOLVER_CACHE_TTL
+    seconds ago: its result would be reused anyway. Returns True if a task was enqueued."""
+    key = pidresolver.get_actionable_pid_url(pid) or pid
+    if recent_resolution_requests.get(key):
+        return False
+    recent_resolution_requests.put(key, True)
+    resolve_pid_task.delay(pid)
+    return True
+
+
+def request_pid_resolutions(pids: Iterable[str]) -> int:
+    """Bulk version of request_pid_resolution(): enqueues the (distinct) PIDs that were not enqueued recently, in
+    resolve_pid_chunk_task messages of CELERY_CHUNK_SIZE PIDs. Returns the number of PIDs enqueued."""
+    todo = []
+    for pid in dict.fromkeys(pids):
+        key = pidresolver.get_actionable_pid_url(pid) or pid
+        if not recent_resolution_requests.get(key):
+            recent_resolution_requests.put(key, True)
+            todo.append(pid)
+    for i in range(0, len(todo), settings.CELERY_CHUNK_SIZE):
+        resolve_pid_chunk_task.delay(todo[i:i + settings.CELERY_CHUNK_SIZE])
+    return len(todo)
+
+
+def resolve_and_save_pids(pids: List[str], retry: bool = False) -> dict:
+    """Resolves the PIDs concurrently and saves the resolution records in one batch.
+    A PID that fails does not fail the others: a retry is scheduled for it, like for a failed resolve_pid_task.
+    With `retry`, the PIDs are (due) retries: the retries of the PIDs that did not fail again are removed.
+    Returns the HTTP status code, or the error, per PID."""
+    results: dict = {pid: "Identifier scheme not recognised" for pid in pids}
+    records = run_sync(_collect_resolution_records(pids))
+    resolved = []
+    failures = {}
+    for record in records:
+        if record.http_error is None:
+            resolved.append(_observation(record))
+            results[record.pid_id] = record.status_code
+        else:
+            results[record.pid_id] = failures[record.pid_id] = record.http_error
+    save_pid_resolution_records(resolved)
+    schedule_retries(failures)
+    if retry:
+        clear_pid_retries(pid for pid in pids if pid not in failures)
+    logger.info("Resolved chunk of %s PIDs: %s failed.", len(pids), len(failures),
+                extra={"event": "pid_chunk_resolved"})
+    return results
+
+
+async def _collect_resolution_records(pids: List[str]) -> list[pidresolver.ResolutionRecord]:
+    return [record async for record in pidresolver.resolve_pids(pids)]
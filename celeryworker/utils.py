@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from celery import current_app as current_celery_app
 from celery.result import AsyncResult
 
@@ -18,6 +20,12 @@ def create_celery():
     return celery_app
 
 
+@lru_cache(maxsize=None)
+def get_celery():
+    """The Celery app, configured (create_celery) once, on first use."""
+    return create_celery()
+
+
 def get_task_info(task_id):
     """
     return task info for the given task_id
@@ -0,0 +1,57 @@
+"""Async versions of the crud functions used by the async routes (AsyncSession, see database.get_async_db)."""
+import asyncio
+
+from typing import Union
+
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from schemas.schemas import User, PIDMResolutionEvent
+from utils.auth import verify_password
+from .crud import pid_recheck_insert
+from .models import PIDMREvent, Users
+
+
+async def create_pidmr_event(db: AsyncSession, event: PIDMResolutionEvent):
+    db_event = PIDMREvent(time_stamp=event.time_stamp, pid_id=event.pid_id, pid_mode=event.pid_mode,
+                          pid_type=event.pid_type,
+                          pid_endpoint=event.pid_endpoint)
+    db.add(db_event)
+    await db.execute(pid_recheck_insert([event.pid_endpoint]))  # a known PID, to be re-checked
+    await db.commit()  # The id is set by the INSERT (RETURNING), and the session does not expire it on commit.
+    return db_event
+
+
+async def create_pidmr_events(db: AsyncSession, events: list[PIDMResolutionEvent]) -> list[int]:
+    """Inserts the events in one multi-row INSERT statement. Returns their ids, in the order of the events."""
+    if not events:
+        return []
+    ids = await db.scalars(insert(PIDMREvent).returning(PIDMREvent.id, sort_by_parameter_order=True),
+                           [dict(time_stamp=event.time_stamp, pid_id=event.pid_id, pid_mode=event.pid_mode,
+                                 pid_type=event.pid_type, pid_endpoint=event.pid_endpoint) for event in events])
+    ids = ids.all()
+    await db.execute(pid_recheck_insert(event.pid_endpoint for event in events))
+    await db.commit()
+    return ids
+
+
+async def authenticate_user(db: AsyncSession, username: str, password: str) -> Union[User, bool]:
+    user = await db.scalar(select(Users).where(Users.username == username).limit(1))
+    # bcrypt is slow by design: it runs in a thread, so it does not block the event loop.
+    if user and await asyncio.to_thread(verify_password, password, user.password_hash):
+        return User(
+            username=user.username,
+            disabled=user.disabled,
+            timestamp=user.time_stamp
+        )
+    return False
+
+
+async def get_user_by_username(db: AsyncSession, username: str) -> Union[User, bool]:
+    user = await db.scalar(select(Users).where(Users.username == username).limit(1))
+    if user:
+        return User(
+            username=user.username,
+            disabled=user.disabled,
+            timestamp=user.time_stamp
+        )
+    return False
@@ -1,10 +1,24 @@
-from typing import Union
+import math
+import random
+import time
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, Optional, Union
 
+from sqlalchemy import ARRAY, String, and_, bindparam, case, delete, exists, func, insert, literal, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 from schemas.schemas import User, PIDMResolutionEvent, PIDMResolutionRecord
-from utils.auth import verify_password
-from .database import get_db
-from .models import PIDMREvent, MonitorRecord, Users
+from settings import settings
+from utils.auth import verify_password, invalidate_user
+from utils.metrics import Histogram
+from .database import SessionLocal
+from .models import PIDMREvent, MonitorRecord, PIDRecheck, ResolutionRetry, HostCircuit, Users
+
+# Every save of resolution records: of the write-behind buffer (database/writer.py) and of the chunk tasks.
+flush_seconds = Histogram("prm_db_flush_seconds", "Saves of resolution records (one transaction each), by result.",
+                          ("result",))
+flush_records = Histogram("prm_db_flush_records", "Resolution records per save.",
+                          buckets=(1, 10, 50, 100, 250, 500, 1000, 2500, 5000))
 
 
 def create_pidmr_event(db: Session, event: PIDMResolutionEvent):
@@ -12,13 +26,14 @@ def create_pidmr_event(db: Session, event: PIDMResolutionEvent):
                           pid_type=event.pid_type,
                           pid_endpoint=event.pid_endpoint)
     db.add(db_event)
+    db.execute(pid_recheck_insert([event.pid_endpoint]))
     db.commit()
     db.refresh(db_event)
     return db_event
 
 
-def save_pid_resolution_record(record: PIDMResolutionRecord):
-    db_record = MonitorRecord(
+def _monitor_record_values(record: PIDMResolutionRecord) -> dict:
+    return dict(
         time_stamp=record.time_stamp,
         pid_id=record.pid_id,
         pid_url=record.pid_url,
@@ -26,13 +41,307 @@ def save_pid_resolution_record(record: PIDMResolutionRecord):
         ssl_verified=record.ssl_verified,
         redirect_count=record.redirect_count,
         resolution_url=record.resolution_url,
-        http_error=record.http_error
+        http_error=record.http_error,
+        elapsed_ms=getattr(record, "elapsed_ms", None),
+        hop_timings=[[hop.host, hop.status_code, hop.wait_ms, hop.connect_ms, hop.tls_ms, hop.ttfb_ms, hop.total_ms]
+                     for hop in getattr(record, "hops", ())] or None
     )
-    db = next(get_db())
-    db.add(db_record)
-    db.commit()
-    db.refresh(db_record)
-    return db_record
+
+
+def save_pid_resolution_record(record: PIDMResolutionRecord) -> None:
+    """Saves one record, see save_pid_resolution_records()."""
+    save_pid_resolution_records([record])
+
+
+def save_pid_resolution_records(records: Iterable[PIDMResolutionRecord]) -> None:
+    """Saves the records in one transaction, as multi-row INSERT statement(s) (SQLAlchemy "insertmanyvalues").
+    With PID_RESOLUTION_STORAGE = "rle" only state transitions are inserted, see _save_run_length_encoded()."""
+    rows = [_monitor_record_values(record) for record in records]
+    if not rows:
+        return
+    start = time.perf_counter()
+    try:
+        with SessionLocal() as db, db.begin():
+            if settings.PID_RESOLUTION_STORAGE == "rle":
+                _save_run_length_encoded(db, rows)
+            else:
+                db.execute(insert(MonitorRecord), rows)
+            _save_pid_rechecks(db, rows)
+    except Exception:
+        flush_seconds.observe(time.perf_counter() - start, "failed")
+        raise
+    flush_seconds.observe(time.perf_counter() - start, "ok")
+    flush_records.observe(len(rows))
+
+
+def pid_recheck_insert(pids: Iterable[str]):
+    """The INSERT of the PIDs into pid_recheck as never checked (due first), unless they are known already."""
+    return pg_insert(PIDRecheck).values([{"pid_id": pid} for pid in sorted(set(pids))]).on_conflict_do_nothing()
+
+
+def _save_pid_rechecks(db: Session, rows: list[dict]) -> None:
+    """Sets the last check of the PIDs in pid_recheck, and when they are due again: PID_RECHECK_WINDOW after it, or
+    PID_RECHECK_FAILING_WINDOW if it failed (no response, or status code >= 400)."""
+    latest: dict[str, dict] = {}
+    for row in sorted(rows, key=lambda row: row["time_stamp"]):
+        latest[row["pid_id"]] = row
+    values = []
+    for pid_id, row in sorted(latest.items()):  # in a fixed order: concurrent upserts do not deadlock
+        failing = row["status_code"] is None or int(row["status_code"]) >= 400
+        window = settings.PID_RECHECK_FAILING_WINDOW if failing else settings.PID_RECHECK_WINDOW
+        values.append({"pid_id": pid_id, "checked": row["time_stamp"],
+                       "due_at": row["time_stamp"] + timedelta(seconds=window)})
+    statement = pg_insert(PIDRecheck).values(values)
+    db.execute(statement.on_conflict_do_update(
+        index_elements=[PIDRecheck.pid_id],
+        set_={"checked": statement.excluded.checked, "due_at": statement.excluded.due_at},
+        where=PIDRecheck.checked.is_(None) | (PIDRecheck.checked <= statement.excluded.checked)))
+
+
+def _observation_key(row) -> tuple:
+    if isinstance(row, dict):
+        return row["status_code"], row["resolution_url"], row["ssl_verified"], row["redirect_count"], row["http_error"]
+    return row.status_code, row.resolution_url, row.ssl_verified, row.redirect_count, row.http_error
+
+
+def _save_run_length_encoded(db: Session, rows: list[dict]) -> None:
+    """While the (status_code, resolution_url, ssl_verified, redirect_count, http_error) of a PID is unchanged, its
+    latest row is extended (last_seen, observation_count) instead of inserting a new row. A changed result opens a new
+    row. The timings (elapsed_ms, hop_timings) of a row are those of its latest observation.
+    The PIDs are locked (transaction-level advisory locks, in a fixed order) before their latest rows are read: a
+    concurrent writer of the same PID waits until this transaction committed, and then sees its rows."""
+    rows.sort(key=lambda row: row["time_stamp"])
+    pids = sorted({row["pid_id"] for row in rows})
+    pid_ids = func.unnest(literal(pids, ARRAY(String))).table_valued("pid_id").render_derived()
+    keys = select(func.hashtext(pid_ids.c.pid_id).label("key")).distinct().order_by("key").subquery()
+    db.execute(select(func.pg_advisory_xact_lock(func.hashtext("pid_resolution"), keys.c.key)))
+    latest_ids = (select(func.max(MonitorRecord.id))
+                  .where(MonitorRecord.pid_id.in_(pids))
+                  .group_by(MonitorRecord.pid_id))
+    latest = db.execute(select(MonitorRecord.id, MonitorRecord.time_stamp, MonitorRecord.pid_id,
+                               MonitorRecord.status_code, MonitorRecord.resolution_url, MonitorRecord.ssl_verified,
+                               MonitorRecord.redirect_count, MonitorRecord.http_error, MonitorRecord.observation_count)
+                        .where(MonitorRecord.id.in_(latest_ids)))
+    runs: dict[str, dict] = {}  # pid_id -> the open run: an existing row (to update) or a new row (to insert)
+    updates: dict[int, dict] = {}
+    for run in latest:
+        runs[run.pid_id] = {"run_id": run.id, "run_time_stamp": run.time_stamp, "key": _observation_key(run),
+                            "run_count": run.observation_count}
+    inserts = []
+    for row in rows:
+        run = runs.get(row["pid_id"])
+        if run is not None and run["key"] == _observation_key(row):
+            run["run_count"] += 1
+            run["run_last_seen"] = row["time_stamp"]
+            run["run_elapsed_ms"], run["run_hop_timings"] = row["elapsed_ms"], row["hop_timings"]
+            if "run_id" in run:
+                updates[run["run_id"]] = run
+            else:
+                run["row"].update(last_seen=row["time_stamp"], observation_count=run["run_count"],
+                                  elapsed_ms=row["elapsed_ms"], hop_timings=row["hop_timings"])
+        else:
+            row.update(last_seen=row["time_stamp"], observation_count=1)
+            inserts.append(row)
+            runs[row["pid_id"]] = {"key": _observation_key(row), "run_count": 1, "row": row}
+    if updates:
+        table = MonitorRecord.__table__
+        db.execute(update(table)  # by the primary key, time_stamp included: one partition
+                   .where(table.c.id == bindparam("run_id"), table.c.time_stamp == bindparam("run_time_stamp"))
+                   .values(last_seen=bindparam("run_last_seen"), observation_count=bindparam("run_count"),
+                           elapsed_ms=bindparam("run_elapsed_ms"), hop_timings=bindparam("run_hop_timings")),
+                   [{"run_id": run_id, "run_time_stamp": run["run_time_stamp"], "run_last_seen": run["run_last_seen"],
+                     "run_count": run["run_count"], "run_elapsed_ms": run["run_elapsed_ms"],
+                     "run_hop_timings": run["run_hop_timings"]}
+                    for run_id, run in updates.items()])
+    if inserts:
+        db.execute(insert(MonitorRecord), inserts)
+
+
+def expand_observations(record: MonitorRecord) -> Iterator[dict]:
+    """Expands a (run-length encoded) row into its observations. The time stamps of the observations between the
+    first and the last one are not stored: they are spread evenly over the interval."""
+    values = {column.name: getattr(record, column.name) for column in MonitorRecord.__table__.columns
+              if column.name not in ("last_seen", "observation_count")}
+    first, last, count = record.time_stamp, record.last_seen or record.time_stamp, record.observation_count or 1
+    step = (last - first) / (count - 1) if count > 1 else None
+    for i in range(count):
+        yield {**values, "time_stamp": first + step * i if step else first}
+
+
+def get_pid_resolution_history(db: Session, pid_id: str, expand: bool = True) -> Iterator[dict]:
+    """Returns the resolution history of a PID, oldest first: one item per observation, or per stored row (interval)."""
+    records = db.scalars(select(MonitorRecord).where(MonitorRecord.pid_id == pid_id).order_by(MonitorRecord.time_stamp))
+    for record in records:
+        if expand:
+            yield from expand_observations(record)
+        else:
+            yield {column.name: getattr(record, column.name) for column in MonitorRecord.__table__.columns}
+
+
+def pid_resolution_filters(since: Optional[datetime] = None, until: Optional[datetime] = None,
+                           pid_prefix: Optional[str] = None, host: Optional[str] = None,
+                           status: Optional[str] = None) -> list:
+    """The conditions on pid_resolution rows for the export filters: (first) observation from `since` until `until`
+    (exclusive), PID starting with `pid_prefix`, `host` of the PID URL, and `status`: a status code (404), a class of
+    status codes (5xx) or "error" (no response). Raises ValueError for an invalid status."""
+    filters = []
+    if since:
+        filters.append(MonitorRecord.time_stamp >= since)
+    if until:
+        filters.append(MonitorRecord.time_stamp < until)
+    if pid_prefix:
+        filters.append(MonitorRecord.pid_id.startswith(pid_prefix, autoescape=True))
+    if host:
+        filters.append(func.lower(func.substring(MonitorRecord.pid_url, r'^https?://([^/:?#]+)')) == host.lower())
+    if status:
+        status = status.lower()
+        if status == "error":
+            filters.append(MonitorRecord.status_code.is_(None))
+        elif len(status) == 3 and status[0] in "12345" and status[1:] == "xx":
+            filters.append(MonitorRecord.status_code.between(int(status[0]) * 100, int(status[0]) * 100 + 99))
+        elif status.isdigit():
+            filters.append(MonitorRecord.status_code == int(status))
+        else:
+            raise ValueError(f"Invalid status filter: {status}, expected a status code, a class (e.g. 5xx) or 'error'.")
+    return filters
+
+
+def select_pid_resolutions(db: Session, filters: list, batch_size: int = 1000) -> Iterator:
+    """Streams the pid_resolution rows matching the filters (see pid_resolution_filters), oldest first. The rows are
+    fetched from a server-side cursor, `batch_size` at a time, as plain rows (not ORM objects)."""
+    query = (select(*MonitorRecord.__table__.columns)
+             .where(*filters)
+             .order_by(MonitorRecord.time_stamp, MonitorRecord.id)
+             .execution_options(yield_per=batch_size))
+    return db.execute(query)
+
+
+def schedule_pid_retries(failures: dict[str, str], max_retries: int, delay: float, jitter: float) -> list[str]:
+    """Schedules a retry, `delay` ± `jitter` seconds from now, for each failed PID (pid -> error).
+    Returns the PIDs that failed their last retry: their retry is removed, the caller records the failure."""
+    if not failures:
+        return []
+    if max_retries <= 0:
+        return list(failures)
+    now = datetime.now()
+    exhausted = []
+    with SessionLocal() as db, db.begin():
+        scheduled = db.scalars(select(ResolutionRetry)
+                               .where(ResolutionRetry.pid_id.in_(failures))
+                               .with_for_update())
+        scheduled = {retry.pid_id: retry for retry in scheduled}
+        new = []
+        for pid, error in failures.items():
+            due_at = now + timedelta(seconds=delay + random.uniform(-jitter, jitter))
+            retry = scheduled.get(pid)
+            if retry is None:
+                new.append({"pid_id": pid, "retries": 0, "due_at": due_at, "last_error": error, "time_stamp": now})
+            elif retry.retries + 1 >= max_retries:
+                db.delete(retry)
+                exhausted.append(pid)
+            else:
+                retry.retries += 1
+                retry.due_at = due_at
+                retry.last_error = error
+        if new:  # A concurrent failure of the same PID may have scheduled it already.
+            db.execute(pg_insert(ResolutionRetry).on_conflict_do_nothing(index_elements=["pid_id"]), new)
+    return exhausted
+
+
+def clear_pid_retries(pids: Iterable[str]) -> None:
+    """Removes the scheduled retries of the PIDs, e.g. after they were resolved."""
+    pids = list(pids)
+    if pids:
+        with SessionLocal() as db, db.begin():
+            db.execute(delete(ResolutionRetry).where(ResolutionRetry.pid_id.in_(pids)))
+
+
+def claim_due_pid_retries(limit: int, lease: float) -> list[str]:
+    """Returns (at most `limit`) PIDs whose retry is due, and leases them: they are due again after `lease` seconds,
+    unless their retry reports back before that. Concurrent dispatchers skip each other's rows."""
+    now = datetime.now()
+    with SessionLocal() as db, db.begin():
+        due = db.scalars(select(ResolutionRetry)
+                         .where(ResolutionRetry.due_at <= now)
+                         .order_by(ResolutionRetry.due_at)
+                         .limit(limit)
+                         .with_for_update(skip_locked=True)).all()
+        for retry in due:
+            retry.due_at = now + timedelta(seconds=lease)
+        return [retry.pid_id for retry in due]
+
+
+def count_pid_retries() -> tuple[int, int]:
+    """Returns the number of scheduled retries, and how many of them are due."""
+    with SessionLocal() as db:
+        return tuple(db.execute(select(func.count(), func.count().filter(ResolutionRetry.due_at <= datetime.now()))
+                                .select_from(ResolutionRetry)).one())
+
+
+def select_pid_rechecks(shard: int, shards: int, share: float, limit: int) -> tuple[int, list[str]]:
+    """Returns the size of the shard of the known PID corpus (pid_recheck), and its due PIDs, the ones due the longest
+    first: at most `share` of the shard, and at most `limit`. PIDs that were never checked come first; PIDs with a
+    scheduled retry are left out. The shard of a PID is hashtext(pid) mod `shards`, so a PID always belongs to the same
+    shard. The PIDs are read in the order of the due_at index, so only about `shards` times the PIDs taken are read."""
+    in_shard = func.mod(func.abs(func.hashtext(PIDRecheck.pid_id)), shards) == shard
+    with SessionLocal() as db:
+        total = db.scalar(select(func.count()).select_from(PIDRecheck).where(in_shard))
+        pids = db.scalars(select(PIDRecheck.pid_id)
+                          .where(in_shard, PIDRecheck.due_at.is_(None) | (PIDRecheck.due_at <= datetime.now()))
+                          .where(~exists().where(ResolutionRetry.pid_id == PIDRecheck.pid_id))
+                          .order_by(PIDRecheck.due_at.asc().nulls_first())
+                          .limit(min(math.ceil(total * share), limit))).all()
+    return total, pids
+
+
+def get_host_circuits(window: timedelta) -> dict[str, tuple[int, Optional[datetime]]]:
+    """Returns the failing hosts: host -> (consecutive failures, opened_until). Closed circuits whose last failure is
+    older than `window` are left out, and removed: only if there are any, the refresh of every process is a read."""
+    now = datetime.now()
+    expired = HostCircuit.opened_until.is_(None) & (HostCircuit.updated < now - window)
+    with SessionLocal() as db, db.begin():
+        circuits = db.execute(select(HostCircuit.host, HostCircuit.failures, HostCircuit.opened_until,
+                                     expired.label("expired"))).all()
+        if any(circuit.expired for circuit in circuits):
+            db.execute(delete(HostCircuit).where(expired))
+        return {circuit.host: (circuit.failures, circuit.opened_until) for circuit in circuits if not circuit.expired}
+
+
+def record_host_failure(host: str, threshold: int, window: timedelta, open_for: timedelta) -> tuple[int, Optional[datetime]]:
+    """Counts a failure of the host and opens its circuit (for `open_for`) at `threshold` consecutive failures. A failure
+    more than `window` after the previous one of a closed circuit counts as the first. Returns (failures, opened_until)."""
+    now = datetime.now()
+    table = HostCircuit.__table__
+    failures = case((and_(table.c.opened_until.is_(None), table.c.updated < now - window), 1),
+                    else_=table.c.failures + 1)
+    statement = (pg_insert(table)
+                 .values(host=host, failures=1, opened_until=now + open_for if threshold <= 1 else None, updated=now)
+                 .on_conflict_do_update(index_elements=[table.c.host], set_={
+                     "failures": failures,
+                     "opened_until": case((failures >= threshold, now + open_for), else_=table.c.opened_until),
+                     "updated": now})
+                 .returning(table.c.failures, table.c.opened_until))
+    with SessionLocal() as db, db.begin():
+        return tuple(db.execute(statement).one())
+
+
+def claim_host_probe(host: str, lease: timedelta) -> tuple[bool, Optional[datetime]]:
+    """Claims the probe of a half-open circuit (open until now or earlier): it is open for `lease` more, so other
+    requests still fail fast. Returns (claimed, opened_until); opened_until is None if the circuit is closed."""
+    now = datetime.now()
+    with SessionLocal() as db, db.begin():
+        opened_until = db.scalar(update(HostCircuit)
+                                 .where(HostCircuit.host == host, HostCircuit.opened_until <= now)
+                                 .values(opened_until=now + lease)
+                                 .returning(HostCircuit.opened_until))
+        if opened_until:
+            return True, opened_until
+        return False, db.scalar(select(HostCircuit.opened_until).where(HostCircuit.host == host))
+
+
+def close_host_circuit(host: str) -> None:
+    with SessionLocal() as db, db.begin():
+        db.execute(delete(HostCircuit).where(HostCircuit.host == host))
 
 
 def authenticate_user(db: Session, username: str, password: str) -> Union[User, bool]:
@@ -55,3 +364,11 @@ def get_user_by_username(db: Session, username: str) -> Union[User, bool]:
             timestamp=user.time_stamp
         )
     return False
+
+
+def set_user_disabled(db: Session, username: str, disabled: bool = True) -> bool:
+    """(Dis)ables the user. Returns False if there is no such user. Its cached authentication (this process) is dropped."""
+    updated = db.execute(update(Users).where(Users.username == username).values(disabled=disabled)).rowcount
+    db.commit()
+    invalidate_user(username)
+    return bool(updated)
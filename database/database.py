@@ -1,7 +1,8 @@
 import os
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, make_url
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
@@ -11,6 +12,12 @@ engine = create_engine(postgres_connection_string, echo=False, future=True, pool
                        max_overflow=10)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# Async (asyncpg) engine for the async FastAPI routes, so database I/O does not block the event loop.
+# The sync engine above is used by the Celery workers and the sync routes.
+async_engine = create_async_engine(make_url(postgres_connection_string).set(drivername="postgresql+asyncpg"),
+                                   echo=False, pool_recycle=3600, pool_size=5, max_overflow=10)
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
 Base = declarative_base()
 
 
@@ -32,3 +39,17 @@ def get_db():
         raise e
     finally:
         db.close()
+
+
+async def get_async_db():
+    """Async version of get_db, for async routes.
+
+    Yields:
+        db: AsyncSession
+    """
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+        except SQLAlchemyError as e:
+            await db.rollback()
+            raise e
@@ -0,0 +1,157 @@
+"""Streaming export of the resolution history (pid_resolution) as NDJSON, CSV or Parquet (needs pyarrow).
+The rows are read from a server-side cursor, EXPORT_BATCH_SIZE at a time, and written out per batch: memory use does
+not depend on the size of the export. Used by GET /pid/export, and from the command line:
+
+    python -m database.export --format csv --since 2024-01-01 --pid-prefix 10.17026/ --output history.csv
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+from datetime import datetime
+from typing import Iterable, Iterator, Optional
+
+from sqlalchemy import Boolean, DateTime, Integer, JSON
+
+from settings import settings
+from .crud import expand_observations, pid_resolution_filters, select_pid_resolutions
+from .database import SessionLocal
+from .models import MonitorRecord
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv", "parquet": "application/vnd.apache.parquet"}
+_RLE_COLUMNS = ("last_seen", "observation_count")
+
+
+def export_columns(expand: bool = False) -> list:
+    return [column for column in MonitorRecord.__table__.columns if not (expand and column.name in _RLE_COLUMNS)]
+
+
+def export_rows(since: Optional[datetime] = None, until: Optional[datetime] = None, pid_prefix: Optional[str] = None,
+                host: Optional[str] = None, status: Optional[str] = None, expand: bool = False) -> Iterator[dict]:
+    """The matching rows, oldest first. With expand, one item per observation (see crud.expand_observations).
+    Raises ValueError for an invalid filter at once, not when the rows are read."""
+    filters = pid_resolution_filters(since=since, until=until, pid_prefix=pid_prefix, host=host, status=status)
+    return _export_rows(filters, expand)
+
+
+def _export_rows(filters: list, expand: bool) -> Iterator[dict]:
+    with SessionLocal() as db:
+        for row in select_pid_resolutions(db, filters, batch_size=settings.EXPORT_BATCH_SIZE):
+            if expand:
+                yield from expand_observations(row)
+            else:
+                yield row._asdict()
+
+
+def export(rows: Iterable[dict], export_format: str, expand: bool = False) -> Iterator[bytes]:
+    """Encodes the rows in the format, per batch of EXPORT_BATCH_SIZE rows.
+    Raises ValueError for an unknown format, or for Parquet without pyarrow."""
+    if export_format == "ndjson":
+        return _ndjson(rows)
+    if export_format == "csv":
+        return _csv(rows, [column.name for column in export_columns(expand)])
+    if export_format == "parquet":
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ValueError("The Parquet export needs pyarrow (pip install pyarrow).") from None
+        return _parquet(rows, export_columns(expand))
+    raise ValueError(f"Unknown export format: {export_format}, expected one of {', '.join(FORMATS)}")
+
+
+def _batches(rows: Iterable[dict]) -> Iterator[list[dict]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= settings.EXPORT_BATCH_SIZE:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _ndjson(rows: Iterable[dict]) -> Iterator[bytes]:
+    for batch in _batches(rows):
+        yield "".join(json.dumps(row, default=_json_default) + "\n" for row in batch).encode()
+
+
+def _csv(rows: Iterable[dict], fieldnames: list[str]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
+    writer.writeheader()
+    for batch in _batches(rows):
+        for row in batch:
+            writer.writerow({**row, "hop_timings": json.dumps(row["hop_timings"]) if row.get("hop_timings") else None})
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()  # only the header: no rows
+
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file for the Parquet writer: keeps the bytes written since the last drain()."""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def _parquet(rows: Iterable[dict], columns: list) -> Iterator[bytes]:
+    """One row group per batch. hop_timings is written as a JSON string."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    types = {Integer: pa.int64(), DateTime: pa.timestamp("us"), Boolean: pa.bool_(), JSON: pa.string()}
+    schema = pa.schema([(column.name, types.get(type(column.type), pa.string())) for column in columns])
+    sink = _ChunkSink()
+    with pq.ParquetWriter(sink, schema) as writer:
+        for batch in _batches(rows):
+            for row in batch:
+                row["hop_timings"] = json.dumps(row["hop_timings"]) if row.get("hop_timings") else None
+            writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+            yield sink.drain()
+    yield sink.drain()  # the footer
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports the resolution history (pid_resolution).")
+    parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="from this time stamp (ISO 8601), inclusive")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="until this time stamp (ISO 8601), exclusive")
+    parser.add_argument("--pid-prefix", help="PIDs starting with this prefix, e.g. 10.17026/")
+    parser.add_argument("--host", help="host of the PID URL, e.g. doi.org")
+    parser.add_argument("--status", help="status code (e.g. 404), class (e.g. 5xx) or 'error' (no response)")
+    parser.add_argument("--expand", action="store_true", help="one line per observation instead of per interval")
+    parser.add_argument("--output", help="file, default: stdout")
+    args = parser.parse_args()
+    try:
+        chunks = export(export_rows(since=args.since, until=args.until, pid_prefix=args.pid_prefix, host=args.host,
+                                    status=args.status, expand=args.expand), args.format, expand=args.expand)
+    except ValueError as e:
+        parser.error(str(e))
+    with open(args.output, "wb") if args.output else sys.stdout.buffer as output:
+        for chunk in chunks:
+            output.write(chunk)
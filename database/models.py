@@ -1,11 +1,12 @@
 from datetime import datetime
-from sqlalchemy import Column, Integer, String, DateTime, Boolean
+from sqlalchemy import Column, Integer, String, Date, DateTime, Boolean, JSON, Index
 from .database import Base
 
 class MonitorRecord(Base):
+    # Partitioned by range of time_stamp (the primary key includes it), see database/retention.py.
     __tablename__ = "pid_resolution"
-    id = Column(Integer, primary_key=True)
-    time_stamp = Column(DateTime, nullable=False, default=datetime.now)
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    time_stamp = Column(DateTime, primary_key=True, default=datetime.now)  # (first) observation
     pid_id = Column(String, nullable=False)  # pid of the record
     pid_url = Column(String, nullable=False)  # actionable url of the pid
     status_code = Column(Integer, nullable=True)  # status codes or unresolved
@@ -13,6 +14,82 @@ class MonitorRecord(Base):
     redirect_count = Column(Integer, nullable=True)  # number of redirects
     resolution_url = Column(String, nullable=True)  # resolved url
     http_error = Column(String, nullable=True)  # error message
+    # Run-length encoding: the same result was observed observation_count times, from time_stamp until last_seen.
+    last_seen = Column(DateTime, nullable=True)  # last observation, NULL: time_stamp
+    observation_count = Column(Integer, nullable=False, default=1, server_default="1")
+    # Timings (ms) of the latest observation. hop_timings: one array per request (the PID URL and its redirects):
+    # [host, status_code, wait_ms, connect_ms, tls_ms, ttfb_ms, total_ms], see api.pidresolver.HopTiming.
+    elapsed_ms = Column(Integer, nullable=True)
+    hop_timings = Column(JSON, nullable=True)
+
+    __table_args__ = (
+        # History of a PID (and PID prefix, text_pattern_ops: LIKE 'prefix%'), and time ranges: see crud.
+        Index("ix_pid_resolution_pid_id_time_stamp", "pid_id", "time_stamp",
+              postgresql_ops={"pid_id": "text_pattern_ops"}),
+        Index("ix_pid_resolution_time_stamp", "time_stamp"),
+        {"postgresql_partition_by": "RANGE (time_stamp)"},
+    )
+
+
+class PIDResolutionDaily(Base):
+    """Daily rollup of pid_resolution per PID: the observations (checks) of the day, see database/retention.py."""
+    __tablename__ = "pid_resolution_daily"
+    day = Column(Date, primary_key=True)
+    pid_id = Column(String, primary_key=True)
+    checks = Column(Integer, nullable=False)
+    successes = Column(Integer, nullable=False)  # status code < 400; success rate: successes / checks
+    status_counts = Column(JSON, nullable=False)  # {"200": checks, "404": checks, "error": checks}
+    p50_ms = Column(Integer, nullable=True)  # latency percentiles (elapsed_ms)
+    p90_ms = Column(Integer, nullable=True)
+    p99_ms = Column(Integer, nullable=True)
+
+
+class HostResolutionDaily(Base):
+    """Daily rollup of pid_resolution per host of the PID URL (the resolver)."""
+    __tablename__ = "pid_resolution_host_daily"
+    day = Column(Date, primary_key=True)
+    host = Column(String, primary_key=True)  # "": not an http(s) URL
+    checks = Column(Integer, nullable=False)
+    successes = Column(Integer, nullable=False)
+    status_counts = Column(JSON, nullable=False)
+    p50_ms = Column(Integer, nullable=True)
+    p90_ms = Column(Integer, nullable=True)
+    p99_ms = Column(Integer, nullable=True)
+
+
+class RollupDay(Base):
+    __tablename__ = "pid_resolution_rollup_day"
+    day = Column(Date, primary_key=True)  # rolled up into pid_resolution_daily and pid_resolution_host_daily
+    rolled_up = Column(DateTime, nullable=False, default=datetime.now)
+
+
+class PIDRecheck(Base):
+    """The known PIDs (of pid_resolution and pidmr_events) and when they are due for a re-check, updated on save."""
+    __tablename__ = "pid_recheck"
+    pid_id = Column(String, primary_key=True)
+    checked = Column(DateTime, nullable=True)  # last check, NULL: never checked (a PIDMR event endpoint)
+    due_at = Column(DateTime, nullable=True)  # the last check + PID_RECHECK_(FAILING_)WINDOW, NULL: first
+    __table_args__ = (
+        Index("ix_pid_recheck_due_at", due_at.asc().nulls_first()),
+    )
+
+
+class ResolutionRetry(Base):
+    __tablename__ = "pid_resolution_retry"
+    id = Column(Integer, primary_key=True)
+    pid_id = Column(String, nullable=False, unique=True)
+    retries = Column(Integer, nullable=False, default=0)  # failed retries so far
+    due_at = Column(DateTime, nullable=False, index=True)  # next retry, or end of the lease of a dispatched retry
+    last_error = Column(String, nullable=True)
+    time_stamp = Column(DateTime, nullable=False, default=datetime.now)  # first failure
+
+
+class HostCircuit(Base):
+    __tablename__ = "pid_host_circuit"
+    host = Column(String, primary_key=True)  # resolver or landing page host that failed recently
+    failures = Column(Integer, nullable=False, default=0)  # consecutive connection failures/timeouts
+    opened_until = Column(DateTime, nullable=True)  # NULL: closed, else open until (then half-open), or probe lease
+    updated = Column(DateTime, nullable=False, default=datetime.now)  # last failure
 
 
 class PIDMREvent(Base):
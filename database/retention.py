@@ -0,0 +1,291 @@
+"""Partitions, daily rollups and retention of pid_resolution.
+
+pid_resolution is partitioned by range of time_stamp: one partition (pid_resolution_pYYYYMMDD) per
+PID_RESOLUTION_PARTITION_INTERVAL ("day", "week" or "month"), created PID_RESOLUTION_PARTITIONS_AHEAD intervals ahead.
+Rows outside of the partitions (e.g. when the maintenance did not run for longer) go to the DEFAULT partition,
+pid_resolution_default, and are moved into their partitions when these are created.
+Every completed day is rolled up into pid_resolution_daily (per PID) and pid_resolution_host_daily (per host of the PID
+URL): checks, successes (status code < 400), checks per status code and latency percentiles (elapsed_ms). Partitions
+that ended more than PID_RESOLUTION_RETENTION_DAYS ago, and were rolled up, are dropped as a whole.
+maintain_pid_resolution() runs it all (Celery beat: maintain_pid_resolution_task). From the command line:
+
+    python -m database.retention              # maintenance
+    python -m database.retention --migrate    # converts an existing (unpartitioned) pid_resolution, once
+"""
+import argparse
+import re
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import Connection, delete, func, insert, select, text
+
+from logging_config import prm_logger as logger
+from settings import settings
+from .database import Base, engine
+from .models import HostResolutionDaily, MonitorRecord, PIDResolutionDaily, RollupDay
+
+DEFAULT_PARTITION = "pid_resolution_default"
+_BOUNDS = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+# The columns of pid_resolution, except id, in the order of the model.
+_COLUMNS = ", ".join(column.name for column in MonitorRecord.__table__.columns if column.name != "id")
+# The last observation of a row, as a new row.
+_CARRIED_FORWARD = ", ".join({"time_stamp": "last_seen", "observation_count": "1"}.get(column, column)
+                             for column in _COLUMNS.split(", "))
+
+
+def maintain_pid_resolution(today: Optional[date] = None) -> dict:
+    """Creates the partitions ahead, rolls up the completed days (at most PID_RESOLUTION_ROLLUP_MAX_DAYS per run) and
+    drops the expired partitions. Returns what was done."""
+    today = today or date.today()
+    created = ensure_pid_resolution_partitions(today)
+    rolled_up = rollup_pending_days(today)
+    dropped = drop_expired_partitions(today)
+    logger.info("pid_resolution maintenance: %s partitions created, %s days rolled up, %s partitions dropped.",
+                len(created), len(rolled_up), len(dropped))
+    return {"created": created, "rolled_up": [str(day) for day in rolled_up], "dropped": dropped}
+
+
+def _interval_start(day: date, interval: str) -> date:
+    if interval == "day":
+        return day
+    if interval == "week":
+        return day - timedelta(days=day.weekday())
+    if interval == "month":
+        return day.replace(day=1)
+    raise ValueError(f"Invalid PID_RESOLUTION_PARTITION_INTERVAL: {interval}, expected day, week or month.")
+
+
+def _next_interval(start: date, interval: str) -> date:
+    if interval == "month":
+        return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return start + timedelta(days=7 if interval == "week" else 1)
+
+
+def _lock(connection: Connection) -> None:
+    """One maintenance (of any process) at a time, until the end of the transaction."""
+    connection.execute(select(func.pg_advisory_xact_lock(func.hashtext("pid_resolution_maintenance"))))
+
+
+def is_partitioned(connection: Connection) -> bool:
+    return connection.scalar(text("SELECT relkind FROM pg_class WHERE oid = to_regclass('pid_resolution')")) == "p"
+
+
+def pid_resolution_partitions(connection: Connection) -> list[tuple[str, datetime, datetime]]:
+    """The (name, start, end) of the range partitions of pid_resolution, oldest first."""
+    rows = connection.execute(text("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+                                   "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = 'pid_resolution'::regclass"))
+    partitions = []
+    for name, bound in rows:
+        bounds = _BOUNDS.search(bound)
+        if bounds:  # not the DEFAULT partition
+            partitions.append((name, datetime.fromisoformat(bounds[1]), datetime.fromisoformat(bounds[2])))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def _create_partitions(connection: Connection, first: date, last: date) -> list[str]:
+    """Creates the DEFAULT partition and the partitions from the interval of `first` (or of the oldest row in the
+    DEFAULT partition) until the interval of `last`, except where they would overlap an existing partition (e.g. after a
+    change of the interval). The rows of their range in the DEFAULT partition are moved into them. Returns their names."""
+    interval = settings.PID_RESOLUTION_PARTITION_INTERVAL
+    connection.execute(text(f"CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF pid_resolution DEFAULT"))
+    oldest = connection.scalar(text(f"SELECT min(time_stamp) FROM {DEFAULT_PARTITION}"))
+    if oldest is not None:
+        first = min(first, oldest.date())
+    existing = pid_resolution_partitions(connection)
+    created = []
+    start = _interval_start(first, interval)
+    while start <= last:
+        end = _next_interval(start, interval)
+        lower, upper = datetime.combine(start, datetime.min.time()), datetime.combine(end, datetime.min.time())
+        if not any(lower < existing_end and existing_start < upper for _, existing_start, existing_end in existing):
+            if not created:  # no rows may arrive in the DEFAULT partition until the partitions exist
+                connection.execute(text("LOCK TABLE pid_resolution IN SHARE ROW EXCLUSIVE MODE"))
+            name = f"pid_resolution_p{start:%Y%m%d}"
+            moved = _create_partition(connection, name, lower, upper)
+            if moved:
+                logger.info("Moved %s pid_resolution rows from %s into %s.", moved, DEFAULT_PARTITION, name)
+            created.append(name)
+        start = end
+    return created
+
+
+def _create_partition(connection: Connection, name: str, lower: datetime, upper: datetime) -> int:
+    """Creates the partition `name` for the range from `lower` until `upper`. Its rows in the DEFAULT partition, which
+    would make the CREATE fail, are taken out first and inserted again (into the new partition). Returns their number."""
+    bounds = {"lower": lower, "upper": upper}
+    in_range = f"FROM {DEFAULT_PARTITION} WHERE time_stamp >= :lower AND time_stamp < :upper"
+    moved = 0
+    if connection.scalar(text(f"SELECT EXISTS (SELECT {in_range})"), bounds):
+        moved = connection.execute(text(f"CREATE TEMPORARY TABLE pid_resolution_moved ON COMMIT DROP AS "
+                                        f"WITH moved AS (DELETE {in_range} RETURNING *) SELECT * FROM moved"),
+                                   bounds).rowcount
+    connection.execute(text(f"CREATE TABLE {name} PARTITION OF pid_resolution "
+                            f"FOR VALUES FROM ('{lower.isoformat()}') TO ('{upper.isoformat()}')"))
+    if moved:
+        connection.execute(text("INSERT INTO pid_resolution SELECT * FROM pid_resolution_moved"))
+        connection.execute(text("DROP TABLE pid_resolution_moved"))
+    return moved
+
+
+def ensure_pid_resolution_partitions(today: Optional[date] = None) -> list[str]:
+    """Creates the partitions of pid_resolution from the current interval until PID_RESOLUTION_PARTITIONS_AHEAD
+    intervals ahead. Returns the names of the partitions created. Does nothing if pid_resolution is not partitioned."""
+    today = today or date.today()
+    interval = settings.PID_RESOLUTION_PARTITION_INTERVAL
+    last = _interval_start(today, interval)
+    for _ in range(settings.PID_RESOLUTION_PARTITIONS_AHEAD):
+        last = _next_interval(last, interval)
+    with engine.begin() as connection:
+        _lock(connection)
+        if not is_partitioned(connection):
+            logger.warning("pid_resolution is not partitioned: run python -m database.retention --migrate")
+            return []
+        return _create_partitions(connection, today, last)
+
+
+# The observations of a day, per stored row (run-length encoded: observation_count observations, spread evenly from
+# time_stamp until last_seen, see crud.expand_observations), as a temporary table.
+_OBSERVATIONS = """
+CREATE TEMPORARY TABLE rollup_observations ON COMMIT DROP AS
+WITH stored AS (
+    SELECT pid_id, coalesce(lower(substring(pid_url FROM '^https?://([^/:?#]+)')), '') AS host, status_code, elapsed_ms,
+           observation_count AS n, extract(epoch FROM time_stamp) AS first,
+           extract(epoch FROM coalesce(last_seen, time_stamp) - time_stamp) / greatest(observation_count - 1, 1) AS step
+    FROM pid_resolution
+    WHERE time_stamp < :day_end AND coalesce(last_seen, time_stamp) >= :day_start
+)
+SELECT pid_id, host, status_code, elapsed_ms,
+       CASE WHEN step = 0 THEN CASE WHEN first >= extract(epoch FROM CAST(:day_start AS timestamp)) THEN n ELSE 0 END
+            ELSE greatest(0, least(n - 1, ceil((extract(epoch FROM CAST(:day_end AS timestamp)) - first) / step) - 1)
+                             - greatest(0, ceil((extract(epoch FROM CAST(:day_start AS timestamp)) - first) / step)) + 1)
+       END::integer AS checks
+FROM stored
+"""
+
+# Rolls the observations up per {key}. The percentiles (as percentile_disc) are over the observations, weighted by checks.
+_ROLLUP = """
+INSERT INTO {table} (day, {key}, checks, successes, status_counts, p50_ms, p90_ms, p99_ms)
+WITH by_status AS (
+    SELECT {key}, coalesce(status_code::text, 'error') AS status, coalesce(status_code < 400, false) AS success,
+           sum(checks) AS checks
+    FROM rollup_observations WHERE checks > 0
+    GROUP BY 1, 2, 3
+), cumulative AS (
+    SELECT {key}, elapsed_ms, sum(checks) OVER (PARTITION BY {key} ORDER BY elapsed_ms) AS below,
+           sum(checks) OVER (PARTITION BY {key}) AS total
+    FROM rollup_observations WHERE checks > 0 AND elapsed_ms IS NOT NULL
+), latency AS (
+    SELECT {key}, min(elapsed_ms) FILTER (WHERE below >= 0.5 * total) AS p50,
+           min(elapsed_ms) FILTER (WHERE below >= 0.9 * total) AS p90,
+           min(elapsed_ms) FILTER (WHERE below >= 0.99 * total) AS p99
+    FROM cumulative GROUP BY 1
+)
+SELECT CAST(:day_start AS date), s.{key}, sum(s.checks), coalesce(sum(s.checks) FILTER (WHERE s.success), 0),
+       json_object_agg(s.status, s.checks), l.p50, l.p90, l.p99
+FROM by_status s LEFT JOIN latency l ON l.{key} = s.{key}
+GROUP BY s.{key}, l.p50, l.p90, l.p99
+"""
+
+
+def rollup_day(day: date) -> None:
+    """(Re)computes the rollups of the day, in one transaction, under the maintenance lock."""
+    params = {"day_start": datetime.combine(day, datetime.min.time()),
+              "day_end": datetime.combine(day + timedelta(days=1), datetime.min.time())}
+    with engine.begin() as connection:
+        _lock(connection)
+        connection.execute(delete(PIDResolutionDaily).where(PIDResolutionDaily.day == day))
+        connection.execute(delete(HostResolutionDaily).where(HostResolutionDaily.day == day))
+        connection.execute(text(_OBSERVATIONS), params)
+        connection.execute(text(_ROLLUP.format(table=PIDResolutionDaily.__tablename__, key="pid_id")), params)
+        connection.execute(text(_ROLLUP.format(table=HostResolutionDaily.__tablename__, key="host")), params)
+        connection.execute(delete(RollupDay).where(RollupDay.day == day))
+        connection.execute(insert(RollupDay).values(day=day, rolled_up=datetime.now()))
+
+
+def rollup_pending_days(today: Optional[date] = None) -> list[date]:
+    """Rolls up the completed days after the last rolled up day (or from the first day with data), oldest first, at most
+    PID_RESOLUTION_ROLLUP_MAX_DAYS. Returns the days rolled up."""
+    today = today or date.today()
+    with engine.connect() as connection:
+        last = connection.scalar(select(func.max(RollupDay.day)))
+        if last is None:
+            first = connection.scalar(select(func.min(MonitorRecord.time_stamp)))
+            if first is None:
+                return []
+            last = first.date() - timedelta(days=1)
+    days = [last + timedelta(days=i) for i in range(1, settings.PID_RESOLUTION_ROLLUP_MAX_DAYS + 1)]
+    days = [day for day in days if day < today]
+    for day in days:
+        rollup_day(day)
+    return days
+
+
+def drop_expired_partitions(today: Optional[date] = None) -> list[str]:
+    """Drops the partitions that ended PID_RESOLUTION_RETENTION_DAYS (0: never) or more days ago, if all their days were
+    rolled up. The latest row of a PID that was observed after the end of its partition is carried forward first: its
+    last observation is inserted as a new row, so the PID keeps its current state (and its place in the re-checks)."""
+    if settings.PID_RESOLUTION_RETENTION_DAYS <= 0:
+        return []
+    today = today or date.today()
+    cutoff = datetime.combine(today - timedelta(days=settings.PID_RESOLUTION_RETENTION_DAYS), datetime.min.time())
+    dropped = []
+    with engine.begin() as connection:
+        _lock(connection)
+        if not is_partitioned(connection):
+            return []
+        rolled_up = connection.scalar(select(func.max(RollupDay.day)))
+        if rolled_up is None:
+            return []
+        cutoff = min(cutoff, datetime.combine(rolled_up + timedelta(days=1), datetime.min.time()))
+        for name, _, end in pid_resolution_partitions(connection):
+            if end > cutoff:
+                break
+            connection.execute(text(
+                f"INSERT INTO pid_resolution ({_COLUMNS}) "
+                f"SELECT {_CARRIED_FORWARD} FROM {name} p "
+                f"WHERE p.last_seen >= :end "
+                f"AND NOT EXISTS (SELECT FROM pid_resolution newer WHERE newer.pid_id = p.pid_id AND newer.id > p.id)"),
+                {"end": end})
+            connection.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    for name in dropped:
+        logger.info("Dropped expired partition %s.", name)
+    return dropped
+
+
+def migrate_to_partitions(today: Optional[date] = None) -> int:
+    """Converts an existing, unpartitioned pid_resolution into a partitioned one, in one transaction: creates the
+    partitioned table, with the DEFAULT partition and partitions from its first row until PID_RESOLUTION_PARTITIONS_AHEAD intervals ahead, copies
+    the rows (and ids) and drops the old table. Stop the writers (Celery workers) first. Returns the rows copied."""
+    today = today or date.today()
+    with engine.begin() as connection:
+        _lock(connection)
+        if is_partitioned(connection):
+            return 0
+        connection.execute(text("ALTER TABLE pid_resolution RENAME TO pid_resolution_unpartitioned"))
+        connection.execute(text("ALTER INDEX pid_resolution_pkey RENAME TO pid_resolution_unpartitioned_pkey"))
+        for index in MonitorRecord.__table__.indexes:
+            connection.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+        MonitorRecord.__table__.create(connection)
+        first = connection.scalar(text("SELECT min(time_stamp) FROM pid_resolution_unpartitioned"))
+        last = _interval_start(today, settings.PID_RESOLUTION_PARTITION_INTERVAL)
+        for _ in range(settings.PID_RESOLUTION_PARTITIONS_AHEAD):
+            last = _next_interval(last, settings.PID_RESOLUTION_PARTITION_INTERVAL)
+        _create_partitions(connection, min(first.date(), today) if first else today, last)
+        copied = connection.execute(text(f"INSERT INTO pid_resolution (id, {_COLUMNS}) "
+                                         f"SELECT id, {_COLUMNS} FROM pid_resolution_unpartitioned")).rowcount
+        connection.execute(text("SELECT setval(pg_get_serial_sequence('pid_resolution', 'id'), "
+                                "coalesce((SELECT max(id) FROM pid_resolution), 0) + 1, false)"))
+        connection.execute(text("DROP TABLE pid_resolution_unpartitioned"))
+    logger.info("Migrated %s pid_resolution rows into partitions.", copied)
+    return copied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Partitions, daily rollups and retention of pid_resolution.")
+    parser.add_argument("--migrate", action="store_true", help="convert an existing, unpartitioned pid_resolution")
+    args = parser.parse_args()
+    Base.metadata.create_all(bind=engine)  # the rollup tables (pid_resolution itself, if it does not exist)
+    if args.migrate:
+        print(f"{migrate_to_partitions()} rows copied.")
+    print(maintain_pid_resolution())
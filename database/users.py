@@ -0,0 +1,22 @@
+"""Management of the API users from the command line:
+
+    python -m database.users disable <username>
+    python -m database.users enable <username>
+
+The API processes cache the users: a disabled user is rejected by all of them within AUTH_USER_CACHE_TTL seconds.
+"""
+import argparse
+import sys
+
+from .crud import set_user_disabled
+from .database import SessionLocal
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Disables or enables an API user.")
+    parser.add_argument("action", choices=("disable", "enable"))
+    parser.add_argument("username")
+    args = parser.parse_args()
+    with SessionLocal() as db:
+        if not set_user_disabled(db, args.username, disabled=args.action == "disable"):
+            sys.exit(f"No such user: {args.username}")
+    print(f"{args.username}: {args.action}d.")
@@ -0,0 +1,80 @@
+import atexit
+import os
+import threading
+import time
+from typing import Optional
+
+from logging_config import prm_logger as logger
+from settings import settings
+from utils.metrics import Counter
+from .crud import save_pid_resolution_records
+
+dropped_records = Counter("prm_db_dropped_records_total", "Resolution records dropped because the buffer was full.")
+
+
+class MonitorRecordWriter:
+    """Write-behind buffer for pid_resolution (MonitorRecord) rows.
+    Records are collected in memory and written in one transaction, as a multi-row INSERT, when the buffer holds
+    `max_size` records or when the oldest buffered record is `max_age` seconds old. Call flush() on shutdown."""
+
+    def __init__(self, max_size: int, max_age: float):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._buffer: list = []
+        self._oldest: Optional[float] = None
+        self._lock = threading.Lock()  # guards the buffer
+        self._flush_lock = threading.Lock()  # one flush at a time, so rows are written in order
+        self._pid: Optional[int] = None
+
+    def add(self, record) -> None:
+        self._ensure_flusher()
+        with self._lock:
+            self._buffer.append(record)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            full = len(self._buffer) >= self.max_size
+        if full:
+            self.flush()
+
+    def flush(self) -> int:
+        """Writes the buffered records. Returns the number of records written."""
+        with self._flush_lock:
+            with self._lock:
+                records, self._buffer, self._oldest = self._buffer, [], None
+            if not records:
+                return 0
+            try:
+                save_pid_resolution_records(records)  # observes prm_db_flush_seconds and prm_db_flush_records
+            except Exception as e:
+                with self._lock:
+                    if len(self._buffer) + len(records) <= self.max_size * 10:
+                        self._buffer[:0] = records  # keep them for the next flush
+                        self._oldest = self._oldest or time.monotonic()
+                    else:
+                        dropped_records.inc(amount=len(records))
+                        logger.error("Dropped %s resolution records, buffer full.", len(records))
+                logger.error("Flushing %s resolution records failed: %s", len(records), e)
+                return 0
+            logger.debug("Flushed %s resolution records.", len(records))
+            return len(records)
+
+    def _ensure_flusher(self) -> None:
+        # Started lazily, in the process that uses it: threads do not survive a fork (Celery prefork workers).
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._buffer, self._oldest = [], None
+                threading.Thread(target=self._flush_aged, name="prm-record-writer", daemon=True).start()
+                atexit.register(self.flush)
+
+    def _flush_aged(self) -> None:
+        while True:
+            time.sleep(min(self.max_age, 1.0))
+            oldest = self._oldest
+            if oldest is not None and time.monotonic() - oldest >= self.max_age:
+                self.flush()
+
+
+monitor_record_writer = MonitorRecordWriter(max_size=settings.DB_WRITE_BATCH_SIZE, max_age=settings.DB_WRITE_MAX_AGE)
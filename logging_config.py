@@ -1,18 +1,110 @@
-import logging.config
+"""Logging setup: the loggers in settings.LOGGERS only put their records on a queue; a background thread (QueueListener)
+formats them and writes them to the (rotating) log file and stdout, as JSON lines (LOG_JSON) or in the `log_format`.
+
+Log calls with `extra={"event": "<name>"}` are sampled at the rate in LOG_SAMPLING (default 1): e.g. the success
+messages of every PID. Warnings and errors are never sampled out. A full queue drops records instead of blocking the
+caller. Use %-style arguments (logger.info("... %s", value)), so the message is only formatted by the writer thread,
+and only if the record is kept.
+"""
+import atexit
+import json
+import logging
+import os
+import queue
+import random
 import sys
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
 from settings import settings
+from utils.metrics import Counter
+
+dropped_records = Counter("prm_log_records_dropped_total", "Log records dropped because the logging queue was full.",
+                          ("logger",))
+_RECORD_ATTRIBUTES = set(logging.makeLogRecord({}).__dict__) | {"message", "asctime", "taskName"}
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per record: time, level, logger, message, and the `extra` fields (e.g. event)."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": self.formatTime(record, self.datefmt), "level": record.levelname, "logger": record.name,
+                 "message": record.getMessage()}
+        entry.update((key, value) for key, value in record.__dict__.items() if key not in _RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class EventSampler(logging.Filter):
+    """Keeps a record below WARNING with an `event` in `rates` with that probability; adds `sample_rate` to it."""
+
+    def __init__(self, rates: dict):
+        super().__init__()
+        self.rates = {event: float(rate) for event, rate in rates.items()}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        rate = self.rates.get(getattr(record, "event", None))
+        if rate is None or record.levelno >= logging.WARNING:
+            return True
+        record.sample_rate = rate
+        return random.random() < rate
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Enqueues the records as they are: they are formatted by the listener thread. Drops a record if the queue is full."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc(record.name)
+
+
+_listeners: dict[DroppingQueueHandler, QueueListener] = {}
+
+
+def _start_listener(queue_handler: DroppingQueueHandler, handlers: tuple[logging.Handler, ...]) -> None:
+    queue_handler.queue = queue.Queue(settings.LOG_QUEUE_SIZE)
+    _listeners[queue_handler] = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+    _listeners[queue_handler].start()
+
+
+def _after_fork_in_child() -> None:
+    # The listener threads do not survive a fork (Celery prefork workers): new queues, new threads.
+    for queue_handler, listener in list(_listeners.items()):
+        _start_listener(queue_handler, listener.handlers)
+
+
+def stop_listeners() -> None:
+    """Writes the queued records, then stops the listener threads."""
+    running = [listener for listener in _listeners.values() if listener._thread and listener._thread.is_alive()]
+    for listener in running:
+        listener.queue.put(listener._sentinel)
+    for listener in running:
+        listener._thread.join()
+
 
 for log in settings.LOGGERS:
     log_setup = logging.getLogger(log.get('name'))
-    formatter = logging.Formatter(log.get('log_format'))
+    if settings.LOG_JSON:
+        formatter = JsonFormatter(datefmt=log.get('log_date_format'))
+    else:
+        formatter = logging.Formatter(log.get('log_format'))
     file_handler = RotatingFileHandler(log.get('log_file'), maxBytes=5 * 1024 * 1024, backupCount=10)
     file_handler.setFormatter(formatter)
     stream_handler = logging.StreamHandler(stream=sys.stdout)
     stream_handler.setFormatter(formatter)
+    queue_handler = DroppingQueueHandler(None)
+    queue_handler.addFilter(EventSampler(settings.LOG_SAMPLING))
     log_setup.setLevel(log.get('log_level'))
-    log_setup.addHandler(file_handler)
-    log_setup.addHandler(stream_handler)
+    log_setup.addHandler(queue_handler)
+    _start_listener(queue_handler, (file_handler, stream_handler))
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+atexit.register(stop_listeners)
 
 pidmr_logger = logging.getLogger('pidmr')
 prm_logger = logging.getLogger('prm')
@@ -1,27 +1,61 @@
+from utils.startup import started  # first: the imports below are part of the startup time
+
+import asyncio
+import threading
 import time
 from contextlib import asynccontextmanager
 
-import emoji
 import uvicorn as uvicorn
 from fastapi import FastAPI
 from starlette.middleware.cors import CORSMiddleware
 
 import api.uptimerobot
-from celeryworker.utils import create_celery
+from api import pidresolver
 from database import models
-from database.database import engine
-from routers import pidresolution, pidmr, users, uptimemonitor
+from database.database import engine, async_engine
+from database.retention import ensure_pid_resolution_partitions
+from logging_config import prm_logger as logger
+from routers import pidresolution, pidmr, users, uptimemonitor, metrics
 from settings import settings
+from utils.eventloop import started_background_loop
+from utils.metrics import Histogram
+
+startup_seconds = Histogram("prm_app_startup_seconds", "API startup, from the import of main: imports, ready to serve.",
+                            ("phase",), buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0))
+
+
+def warm_up() -> None:
+    """Background warm-up, once the API serves: creates the DB metadata and the pid_resolution partitions ahead,
+    imports deferred to first use (idutils, Celery and the tasks), refreshes the UptimeRobot mapping."""
+    try:
+        models.Base.metadata.create_all(bind=engine)
+        ensure_pid_resolution_partitions()
+        print("\N{HIGH VOLTAGE SIGN} Created DB metadata...")
+    except Exception as e:
+        logger.error("Creating the DB metadata failed: %s", e)
+    pidresolver.warm_up()
+    import celeryworker.tasks  # noqa: F401
+    if settings.UPTIMEROBOT_REFRESH_MAPPING_ON_STARTUP:
+        try:
+            api.uptimerobot.UptimeRobot().update_monitors_mapping()
+        except Exception as e:
+            logger.warning("Refreshing the UptimeRobot mapping failed, serving the snapshot: %s", e)
 
 
 @asynccontextmanager
 async def lifespan(application: FastAPI):
-    models.Base.metadata.create_all(bind=engine)
-    print(f"{emoji.emojize(':high_voltage:')} Created DB metadata...")
-    api.uptimerobot.UptimeRobot().update_monitors_mapping()
-    print(f"{emoji.emojize(':high_voltage:')} Refreshed UptimeRobot mappings...")
+    monitors = len(api.uptimerobot.get_monitors_mapping())
+    print(f"\N{HIGH VOLTAGE SIGN} Loaded UptimeRobot mapping snapshot ({monitors} monitors)...")
+    threading.Thread(target=warm_up, name="prm-warm-up", daemon=True).start()
+    startup_seconds.observe(time.perf_counter() - started, "ready")
     yield  # before the yield, will be executed before the application starts
-    print(f"{emoji.emojize(':bomb:')} Stopping DB connectionpool...")
+    print("\N{BOMB} Closing the PID resolver HTTP clients...")
+    await pidresolver.close_async_clients()  # of this event loop (/pid/stream)
+    background_loop = started_background_loop()  # the sync routes resolve on the background loop (run_sync)
+    if background_loop is not None:
+        await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(pidresolver.close_async_clients(), background_loop))
+    print("\N{BOMB} Stopping DB connectionpool...")
+    await async_engine.dispose()
 
 
 def create_app() -> FastAPI:
@@ -37,26 +71,51 @@ def create_app() -> FastAPI:
         allow_methods=["*"],
         allow_headers=["*"],
     )
-    current_app.celery_app = create_celery()
     current_app.include_router(pidresolution.router)
     current_app.include_router(pidmr.router)
     current_app.include_router(uptimemonitor.router)
     current_app.include_router(users.router)
+    current_app.include_router(metrics.router)
     return current_app
 
 
 app = create_app()
-celery = app.celery_app
+startup_seconds.observe(time.perf_counter() - started, "imports")
+
+
+request_seconds = Histogram("prm_http_request_seconds",
+                            "HTTP requests, until the body was sent, by route (path template), method and status.",
+                            ("route", "method", "status"))
 
 
 @app.middleware("http")
 async def add_process_time_header(request, call_next):
-    start_time = time.time()
+    start_time = time.perf_counter()
     response = await call_next(request)
-    process_time = time.time() - start_time
+    process_time = time.perf_counter() - start_time  # until the response starts: the header is sent before the body
+    route = request.scope.get("route")
+    labels = (route.path if route else "unmatched", request.method, str(response.status_code))
+    body = response.body_iterator
+
+    async def timed_body():
+        # Observed when the body is sent, or cut off: the streamed routes (/pid/stream, /pid/export) run in the body.
+        try:
+            async for chunk in body:
+                yield chunk
+        finally:
+            request_seconds.observe(time.perf_counter() - start_time, *labels)
+
+    response.body_iterator = timed_body()
     response.headers["X-Process-Time"] = str(f'{process_time:0.4f} sec')
     return response
 
 
+def __getattr__(name: str):
+    if name == "celery":  # the Celery app of the worker and beat (celery -A main.celery), imported on first use
+        from celeryworker.tasks import celery_app
+        return celery_app
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", port=9000, reload=True)
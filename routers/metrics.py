@@ -0,0 +1,49 @@
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from sqlalchemy.exc import SQLAlchemyError
+
+from database.crud import count_pid_retries
+from logging_config import prm_logger as logger
+from utils import metrics
+
+router = APIRouter(
+    tags=["Metrics"],
+)
+
+
+def _queue_depths():
+    """Messages waiting per Celery queue, from a passive queue_declare (does not create the queue)."""
+    from celeryworker.tasks import celery_app  # Celery is imported on first use, see main.warm_up()
+    depths = {}
+    try:
+        with celery_app.connection_for_read(connect_timeout=2) as connection:
+            connection.ensure_connection(max_retries=0)
+            for queue in celery_app.conf.task_queues or ():
+                try:
+                    with connection.channel() as channel:
+                        depths[(queue.name,)] = channel.queue_declare(queue=queue.name, passive=True).message_count
+                except connection.channel_errors:
+                    pass  # not declared yet: no worker consumed from it
+    except Exception as e:
+        logger.warning("Celery queue depths not available: %s", e)
+    return [("prm_celery_queue_messages", "Messages waiting in the Celery queue.", ("queue",), depths)]
+
+
+def _retry_backlog():
+    try:
+        scheduled, due = count_pid_retries()
+    except SQLAlchemyError as e:
+        logger.warning("PID retry backlog not available: %s", e)
+        return []
+    return [("prm_pid_retries", "PIDs with a scheduled resolution retry, by state.", ("state",),
+             {("scheduled",): scheduled - due, ("due",): due})]
+
+
+metrics.register_collector(_queue_depths)
+metrics.register_collector(_retry_backlog)
+
+
+@router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    """Prometheus metrics of the API, merged with the snapshots of the Celery worker processes (see utils.metrics)."""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,12 +1,16 @@
-from fastapi import APIRouter, Depends, HTTPException
-from sqlalchemy.orm import Session
-from database.crud import create_pidmr_event
-from database.database import get_db
+import asyncio
+import json
+
+from fastapi import APIRouter, Depends, HTTPException, Request
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.async_crud import create_pidmr_event, create_pidmr_events
+from database.database import get_async_db
 from logging_config import pidmr_logger as logger
 from routers.users import get_current_enabled_user
 from schemas.schemas import PIDMResolutionEvent, User
-from celeryworker.tasks import resolve_pid_task
-from typing import Annotated
+from settings import settings
+from typing import Annotated, AsyncIterator
 
 router = APIRouter(
     prefix="/pidmr",
@@ -16,14 +20,77 @@ router = APIRouter(
 
 
 @router.post("/event")
-async def create_event(event: PIDMResolutionEvent, user: Annotated[User, Depends(get_current_enabled_user)], db: Session = Depends(get_db)):
+async def create_event(event: PIDMResolutionEvent, user: Annotated[User, Depends(get_current_enabled_user)], db: AsyncSession = Depends(get_async_db)):
     try:
-        db_event = create_pidmr_event(db=db, event=event)
+        db_event = await create_pidmr_event(db=db, event=event)
         if not db_event:
             raise HTTPException(status_code=400, detail="Error saving event")  # 400 to 499 are client error codes.
-        logger.info(f"PIDMR event saved: {db_event.pid_endpoint} by user {user.username}")
-        # Add a celery task to resolve this PID:
-        resolve_pid_task.delay(db_event.pid_endpoint)
+        logger.info("PIDMR event saved: %s by user %s", db_event.pid_endpoint, user.username,
+                    extra={"event": "pidmr_event_saved"})
+        # Add a celery task to resolve this PID (unless it was added just before). Publishing blocks: in a thread.
+        from celeryworker.tasks import request_pid_resolution  # Celery is imported on first use, see main.warm_up()
+        await asyncio.to_thread(request_pid_resolution, db_event.pid_endpoint)
         return {"event_id": db_event.id, "pid_endpoint": db_event.pid_endpoint}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+
+
+@router.post("/events")
+async def create_events(request: Request, user: Annotated[User, Depends(get_current_enabled_user)],
+                        db: AsyncSession = Depends(get_async_db)):
+    """
+    Bulk version of /pidmr/event: the body is a JSON array of events, or NDJSON (Content-Type: application/x-ndjson)
+    with one event per line. At most PIDMR_BULK_MAX_EVENTS events per request.
+    The valid events are saved with one multi-row INSERT, and their (distinct) endpoints are enqueued for resolution in
+    chunks. Returns, in the order of the events, the event_id or the validation error of each event.
+    """
+    results: list[dict] = []
+    events: list[PIDMResolutionEvent] = []
+    async for item in _bulk_items(request):
+        if len(results) >= settings.PIDMR_BULK_MAX_EVENTS:
+            raise HTTPException(status_code=413, detail=f"More than {settings.PIDMR_BULK_MAX_EVENTS} events.")
+        try:
+            event = PIDMResolutionEvent.model_validate_json(item) if isinstance(item, str) \
+                else PIDMResolutionEvent.model_validate(item)
+        except ValidationError as e:
+            results.append({"error": "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}" if error["loc"]
+                                               else error["msg"] for error in e.errors(include_url=False))})
+            continue
+        events.append(event)
+        results.append({"pid_endpoint": event.pid_endpoint})
+    try:
+        ids = iter(await create_pidmr_events(db=db, events=events))
+        for result in results:
+            if "error" not in result:
+                result["event_id"] = next(ids)
+        # Publishing to the broker blocks, so it is done in a thread.
+        from celeryworker.tasks import request_pid_resolutions
+        enqueued = await asyncio.to_thread(request_pid_resolutions, (event.pid_endpoint for event in events))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Internal Server Error: {e}")
+    logger.info("%s PIDMR events saved by user %s, %s invalid, %s PIDs enqueued.", len(events), user.username,
+                len(results) - len(events), enqueued)
+    return {"saved": len(events), "failed": len(results) - len(events), "enqueued": enqueued, "events": results}
+
+
+async def _bulk_items(request: Request) -> AsyncIterator:
+    """Yields the items of a JSON array (as objects), or the lines of an NDJSON body (as strings) as they arrive."""
+    if request.headers.get("content-type", "").split(";")[0].strip() not in ("application/x-ndjson", "application/jsonl"):
+        try:
+            items = json.loads(await request.body())
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid JSON: {e}")
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail="Expected a JSON array of events, or NDJSON.")
+        for item in items:
+            yield item
+        return
+    rest = b""
+    async for chunk in request.stream():
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        for line in lines:
+            if line.strip():
+                yield line.decode("utf-8", errors="replace")
+    if rest.strip():
+        yield rest.decode("utf-8", errors="replace")
@@ -1,19 +1,22 @@
-from typing import Annotated
+import json
+from datetime import datetime
+from typing import Annotated, Literal, Optional
 
-from celery import group
-from fastapi import APIRouter, Depends
-from starlette.responses import JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from sqlalchemy.orm import Session
+from starlette.responses import JSONResponse, StreamingResponse
 
 from api import pidresolver
-from celeryworker.tasks import resolve_all_pids_task, resolve_pid_task
-from celeryworker.utils import get_task_info
+from database.crud import get_pid_resolution_history
+from database.database import get_db
+from database.export import FORMATS, export, export_rows
 from routers.users import get_current_enabled_user
 from schemas.schemas import Pid, User
 from settings import settings
 
 router = APIRouter(responses={404: {"description": "Not found"}})
 
-MAX_CELERY_GROUP_SIZE = settings.CELERY_MAX_GROUP_SIZE
+CELERY_CHUNK_SIZE = settings.CELERY_CHUNK_SIZE
 
 
 @router.post("/pid/", tags=["PID Resolution"])
@@ -27,23 +30,53 @@ def get_pid_status_codes(pid: Pid, user: Annotated[User, Depends(get_current_ena
     return data
 
 
+@router.post("/pid/stream", tags=["PID Resolution"], response_class=StreamingResponse)
+async def stream_pid_resolutions(pid: Pid, request: Request, user: Annotated[User, Depends(get_current_enabled_user)]):
+    """
+    Resolve the PIDs concurrently (at most PIDRESOLVER_STREAM_CONCURRENCY at a time) and stream each resolution record
+    as an NDJSON line, as soon as it is resolved. Outstanding resolutions are cancelled when the client disconnects.
+    """
+    async def ndjson_lines():
+        pids = []
+        for p in pid.pids:
+            try:
+                error = None if pidresolver.get_actionable_pid_url(p) else "Identifier scheme not recognised"
+            except ValueError as e:  # a malformed PID gets an error line, it does not abort the stream
+                error = str(e)
+            if error:
+                yield json.dumps({"pid_id": p, "http_error": error}) + "\n"
+            else:
+                pids.append(p)
+        # A PID that fails later on (e.g. an invalid URL) is yielded as a record with its http_error.
+        records = pidresolver.resolve_pids(pids, concurrency=settings.PIDRESOLVER_STREAM_CONCURRENCY)
+        try:
+            async for record in records:
+                if await request.is_disconnected():
+                    break
+                yield record.model_dump_json() + "\n"
+        finally:
+            await records.aclose()
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+
 @router.post("/pid/parallel", tags=["PID Resolution"])
 async def get_status_codes(pid: Pid, user: Annotated[User, Depends(get_current_enabled_user)]) -> dict:
     """
-    This uses Celery to perform subtasks in a parallel manner. For each Celery canvas group it creates, it creates one task, that should be picked up by a worker.
+    This uses Celery to resolve the PIDs in a parallel manner. The PIDs are sent in chunks, one message (task) per chunk.
+    A worker resolves the PIDs of a chunk concurrently, and the chunks are spread over the workers.
     """
-    subpidlists = [pid.pids[i:i + MAX_CELERY_GROUP_SIZE]
-                   for i in range(0, len(pid.pids), MAX_CELERY_GROUP_SIZE)]
+    from celeryworker.tasks import resolve_pid_chunk_task  # Celery is imported on first use, see main.warm_up()
+    subpidlists = [pid.pids[i:i + CELERY_CHUNK_SIZE]
+                   for i in range(0, len(pid.pids), CELERY_CHUNK_SIZE)]
 
-    for groupchunk in subpidlists:
-        tasks = [resolve_pid_task.s(pit) for pit in groupchunk]
-        job = group(tasks)
-        job.apply_async()
+    for chunk in subpidlists:
+        resolve_pid_chunk_task.delay(chunk)
 
     result = {
         "PIDs added to the queue": len(pid.pids),
         "Created tasks in parallel": len(subpidlists),
-        "Max group size:": MAX_CELERY_GROUP_SIZE
+        "Chunk size:": CELERY_CHUNK_SIZE
     }
     return result
 
@@ -51,13 +84,59 @@ async def get_status_codes(pid: Pid, user: Annotated[User, Depends(get_current_e
 @router.post("/pid/async", tags=["PID Resolution"])
 async def get_status_codes_async(pid: Pid, user: Annotated[User, Depends(get_current_enabled_user)]):
     """Creates one task for all provided PIDs. It is picked up by only ONE worker..."""
+    from celeryworker.tasks import resolve_all_pids_task
     task_result = resolve_all_pids_task.apply_async(args=[pid.pids])
     return JSONResponse({"task_id": task_result.id})
 
 
+@router.get("/pid/history", tags=["PID Resolution"])
+def get_pid_history(pid: str, user: Annotated[User, Depends(get_current_enabled_user)], expand: bool = True,
+                    db: Session = Depends(get_db)) -> list:
+    """
+    Return the resolution history of a PID, oldest first. With expand (default), one item per check (observation),
+    else the stored intervals, with their last_seen and observation_count
+    """
+    return list(get_pid_resolution_history(db=db, pid_id=pid, expand=expand))
+
+
+@router.get("/pid/export", tags=["PID Resolution"], response_class=StreamingResponse)
+def export_pid_history(user: Annotated[User, Depends(get_current_enabled_user)],
+                       export_format: Annotated[Literal["ndjson", "csv", "parquet"], Query(alias="format")] = "ndjson",
+                       since: Optional[datetime] = None,
+                       until: Optional[datetime] = None, pid_prefix: Optional[str] = None, host: Optional[str] = None,
+                       status: Optional[str] = None, expand: bool = False):
+    """
+    Stream the resolution history (stored rows, oldest first) as NDJSON, CSV or Parquet. Filters: time range of the
+    (first) observation, from `since` until `until`, PID prefix, host of the PID URL and status: a status code (404), a
+    class (5xx) or 'error'. With expand, one row per check (observation)
+    """
+    try:
+        chunks = export(export_rows(since=since, until=until, pid_prefix=pid_prefix, host=host, status=status,
+                                    expand=expand), export_format, expand=expand)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StreamingResponse(chunks, media_type=FORMATS[export_format],
+                             headers={"Content-Disposition": f'attachment; filename="pid_resolution.{export_format}"'})
+
+
+@router.get("/pid/cache", tags=["PID Resolution"])
+async def get_cache_stats(user: Annotated[User, Depends(get_current_enabled_user)]) -> dict:
+    """
+    Return the hit/miss statistics of the PID resolution caches of the API process
+    """
+    from celeryworker.tasks import recent_resolution_requests
+    return {
+        "resolution": pidresolver.get_resolution_cache_stats(),
+        "normalization": pidresolver.get_actionable_pid_url.cache_info()._asdict(),
+        "enqueued_resolutions": recent_resolution_requests.stats()
+    }
+
+
 @router.get("/task/{task_id}", tags=["Celery"])
 async def get_task_status(task_id: str, user: Annotated[User, Depends(get_current_enabled_user)]) -> dict:
     """
     Return the status of a Celery TaskId
     """
+    from celeryworker.tasks import celery_app  # noqa: F401, configures the app of the AsyncResult
+    from celeryworker.utils import get_task_info
     return get_task_info(task_id)
@@ -1,5 +1,3 @@
-import json
-
 from fastapi import APIRouter, HTTPException
 
 from api.uptimerobot import UptimeRobot
@@ -23,19 +21,17 @@ def _get_monitor_ids(input_data) -> str:
 def get_uptime_by_actor_inst_id(input_data: UptimeMonitorsRequest):
     related_monitors = _get_monitor_ids(input_data)
     try:
-        uptime_data = uptime_robot.get_monitors_uptime_by_pidgraph_ids(related_monitors)
+        return uptime_robot.get_monitors_uptime_by_pidgraph_ids(related_monitors)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    return json.loads(uptime_data)
 
 
 @router.get("/uptime/{pidgraph_ids}", response_model=UptimeResponse, summary="Get mean uptime over the last year, for a list of Uptime Monitor ID's ('pid_graph:12345678')", description="The Uptime Monitors are identified by their PID Graph IDs. Multiple monitors must be separated by a hyphen. E.g.: 'pid_graph:E2045F7A-pid_graph:456AFBF9-pid_graph:7E94CE2D'")
 def get_uptime(pidgraph_ids: str):
     try:
-        uptime_data = uptime_robot.get_monitors_uptime_by_pidgraph_ids(pidgraph_ids)
+        return uptime_robot.get_monitors_uptime_by_pidgraph_ids(pidgraph_ids)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    return json.loads(uptime_data)
 
 
 @router.put("/uptimerobot/update", status_code=201, summary="(re-)Creates pid_graph identifier to UptimeRobot identifier mapping.",
@@ -1,5 +1,3 @@
-import jwt
-
 from datetime import timedelta
 from typing import Annotated
 from settings import settings
@@ -8,11 +6,11 @@ from fastapi import APIRouter
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordRequestForm, OAuth2PasswordBearer
 from jwt import InvalidTokenError
-from sqlalchemy.orm import Session
-from database.crud import authenticate_user, get_user_by_username
-from database.database import get_db
-from schemas.schemas import User, Token, TokenData
-from utils.auth import create_access_token, SECRET_KEY, ALGORITHM
+from sqlalchemy.ext.asyncio import AsyncSession
+from database.async_crud import authenticate_user, get_user_by_username
+from database.database import get_async_db
+from schemas.schemas import User, Token
+from utils.auth import create_access_token, decode_access_token, get_cached_user, cache_user
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
@@ -22,23 +20,24 @@ router = APIRouter(
 )
 
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)):
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: AsyncSession = Depends(get_async_db)):
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: str = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
+        username = decode_access_token(token)
     except InvalidTokenError:
         raise credentials_exception
-    user = get_user_by_username(db=db, username=token_data.username)
-    if user is None:
+    if username is None:
         raise credentials_exception
+    user = get_cached_user(username)
+    if user is None:
+        user = await get_user_by_username(db=db, username=username)
+        if not user:
+            raise credentials_exception
+        cache_user(user)
     return user
 
 
@@ -50,8 +49,8 @@ async def get_current_enabled_user(current_user: Annotated[User, Depends(get_cur
 
 @router.post("/token")
 async def login_for_access_token(form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-                                 db: Session = Depends(get_db)) -> Token:
-    user = authenticate_user(db=db, username=form_data.username, password=form_data.password)
+                                 db: AsyncSession = Depends(get_async_db)) -> Token:
+    user = await authenticate_user(db=db, username=form_data.username, password=form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -1,3 +1,7 @@
 PORT=${PORT:-8080}
 uvicorn main:app --host 0.0.0.0 --port "$PORT" &
+# The periodic tasks (Celery beat) must be scheduled by exactly one process: set CELERY_BEAT=1 on one replica only.
+if [ "${CELERY_BEAT:-0}" = "1" ]; then
+  celery -A main.celery beat -l INFO &
+fi
 celery -A main.celery worker -l INFO -Q pid-resolution,pidmr,celery --autoscale=1,10
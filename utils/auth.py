@@ -1,12 +1,21 @@
 import os
+import time
 import bcrypt
 import jwt
 
 from datetime import datetime, timedelta, timezone
+from typing import Optional
+from settings import settings
+from utils.cache import TTLCache
 
 SECRET_KEY = os.environ['JWT_SECRET_KEY']
 ALGORITHM = "HS256"
 
+# Validated tokens -> username for at most AUTH_CACHE_TTL seconds, username -> User for AUTH_USER_CACHE_TTL seconds
+# (see get_current_user). The caches are per process.
+_token_usernames = TTLCache(max_size=settings.AUTH_CACHE_SIZE, ttl=settings.AUTH_CACHE_TTL)
+_users = TTLCache(max_size=settings.AUTH_CACHE_SIZE, ttl=settings.AUTH_USER_CACHE_TTL)
+
 
 def get_password_hash(password) -> str:
     pwd_bytes = password.encode('utf-8')
@@ -29,3 +38,30 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
         to_encode.update({"exp": expire})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
+
+
+def decode_access_token(token: str) -> Optional[str]:
+    """Returns the username (subject) of a valid token, None if it has none. Raises InvalidTokenError if it is invalid.
+    Validated tokens are cached, but not beyond their expiry."""
+    username = _token_usernames.get(token)
+    if username is None:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        username = payload.get("sub")
+        if username is None:
+            return None
+        expires = payload.get("exp")
+        _token_usernames.put(token, username, min(settings.AUTH_CACHE_TTL, expires - time.time()) if expires else None)
+    return username
+
+
+def get_cached_user(username: str):
+    return _users.get(username)
+
+
+def cache_user(user) -> None:
+    _users.put(user.username, user)
+
+
+def invalidate_user(username: str) -> None:
+    """Drops the cached user of this process only: the other processes read it again within AUTH_USER_CACHE_TTL."""
+    _users.pop(username)
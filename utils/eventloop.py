@@ -0,0 +1,34 @@
+import asyncio
+import os
+import threading
+from typing import Any, Coroutine, Optional
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_pid: Optional[int] = None
+_loop_lock = threading.Lock()
+
+
+def get_background_loop() -> asyncio.AbstractEventLoop:
+    """Returns the long-lived event loop of this process, running in a daemon thread.
+    Keeping one loop per process lets the (pooled) async HTTP clients keep their connections alive between calls.
+    A new loop is started after a fork (e.g. Celery prefork workers), since a loop thread does not survive a fork."""
+    global _loop, _loop_pid
+    with _loop_lock:
+        if _loop is None or _loop_pid != os.getpid() or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            _loop_pid = os.getpid()
+            threading.Thread(target=_loop.run_forever, name="prm-event-loop", daemon=True).start()
+        return _loop
+
+
+def started_background_loop() -> Optional[asyncio.AbstractEventLoop]:
+    """Returns the background event loop of this process if it was started, without starting one."""
+    with _loop_lock:
+        if _loop is not None and _loop_pid == os.getpid() and not _loop.is_closed():
+            return _loop
+        return None
+
+
+def run_sync(coro: Coroutine[Any, Any, Any], timeout: Optional[float] = None) -> Any:
+    """Runs the coroutine on the background event loop and blocks until it is done. Exceptions are re-raised."""
+    return asyncio.run_coroutine_threadsafe(coro, get_background_loop()).result(timeout)
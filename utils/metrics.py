@@ -0,0 +1,316 @@
+"""Prometheus-style metrics (text exposition format), without a client library.
+
+Counters and histograms are sharded per thread: an update only touches the shard of its own thread, so the hot path
+takes no lock. The shards are summed when the metrics are collected.
+Every process that updates metrics writes a snapshot to METRICS_DIR every METRICS_SNAPSHOT_INTERVAL seconds. /metrics
+(routers/metrics.py) renders the metrics of its own process merged with the snapshots of the others, e.g. the Celery
+worker processes. The snapshot of an exited process (older than METRICS_SNAPSHOT_MAX_AGE) is added to the totals of the
+exited processes (exited.json) before it is removed, so the merged counters do not go down (a Prometheus counter reset).
+Where the API does not share METRICS_DIR with the workers, run the exporter next to the workers:
+
+    python -m utils.metrics --port 9101
+"""
+import argparse
+import fcntl
+import glob
+import json
+import os
+import tempfile
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Iterable, Iterator, Optional
+
+from settings import settings
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+OTHER = "other"  # label value of the series beyond max_series
+EXITED = "exited.json"  # in METRICS_DIR: the totals of the exited processes
+
+_registry: dict[str, "_Metric"] = {}
+# Collectors return gauge families, computed when the metrics are rendered: (name, help, labelnames, {labels: value}).
+_collectors: list[Callable[[], Iterable[tuple[str, str, tuple, dict]]]] = []
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), max_series: Optional[int] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.max_series = max_series
+        self._local = threading.local()
+        self._shards: list[dict] = []
+        self._label_sets: set = set()
+        self._lock = threading.Lock()  # new shards and new series only
+        _registry[name] = self
+        _ensure_snapshot_writer()
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append(shard)
+        return shard
+
+    def _labels(self, labels: tuple) -> tuple:
+        """The labels of a new series of this thread: beyond max_series (in all threads) they are all OTHER."""
+        with self._lock:
+            if labels not in self._label_sets:
+                if self.max_series is not None and len(self._label_sets) >= self.max_series:
+                    return (OTHER,) * len(labels)
+                self._label_sets.add(labels)
+        return labels
+
+    def _reset(self) -> None:
+        self._local = threading.local()
+        self._shards = []
+        self._label_sets = set()
+        self._lock = threading.Lock()
+
+    def samples(self) -> dict[tuple, object]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        shard = self._shard()
+        if labels not in shard:
+            labels = self._labels(labels)
+            shard.setdefault(labels, 0)
+        shard[labels] += amount
+
+    def samples(self) -> dict[tuple, float]:
+        totals: dict[tuple, float] = {}
+        for shard in list(self._shards):
+            for labels, value in list(shard.items()):
+                totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+
+class Histogram(_Metric):
+    """A series is a list: the count per bucket (the last one is +Inf), then the sum and the count of the values."""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS,
+                 max_series: Optional[int] = None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, max_series)
+
+    def observe(self, value: float, *labels) -> None:
+        shard = self._shard()
+        series = shard.get(labels)
+        if series is None:
+            labels = self._labels(labels)
+            series = shard.get(labels)
+            if series is None:
+                series = shard[labels] = [0] * (len(self.buckets) + 3)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self) -> dict[tuple, list]:
+        totals: dict[tuple, list] = {}
+        for shard in list(self._shards):
+            for labels, series in list(shard.items()):
+                total = totals.setdefault(labels, [0] * len(series))
+                for i, value in enumerate(series):
+                    total[i] += value
+        return totals
+
+
+def register_collector(collector: Callable[[], Iterable[tuple[str, str, tuple, dict]]]) -> None:
+    _collectors.append(collector)
+
+
+def snapshot() -> dict:
+    """The metrics of this process, as a JSON serializable dict."""
+    return {name: {"type": metric.type, "help": metric.documentation, "labelnames": list(metric.labelnames),
+                   "buckets": list(getattr(metric, "buckets", ())),
+                   "series": [[list(labels), value] for labels, value in metric.samples().items()]}
+            for name, metric in list(_registry.items())}
+
+
+def merge(snapshots: Iterable[dict]) -> dict:
+    merged: dict = {}
+    for metrics in snapshots:
+        for name, metric in metrics.items():
+            target = merged.setdefault(name, {**metric, "series": {}})
+            for labels, value in metric["series"]:
+                labels = tuple(labels)
+                if isinstance(value, list):
+                    total = target["series"].setdefault(labels, [0] * len(value))
+                    for i, v in enumerate(value):
+                        total[i] += v
+                else:
+                    target["series"][labels] = target["series"].get(labels, 0) + value
+    return merged
+
+
+def read_snapshots(exclude_pid: Optional[int] = None) -> list[dict]:
+    """The snapshots in METRICS_DIR of (other) processes, and the totals of the exited processes. Snapshots older than
+    METRICS_SNAPSHOT_MAX_AGE (of an exited process) are added to these totals and removed."""
+    if not settings.METRICS_DIR:
+        return []
+    pattern = os.path.join(settings.METRICS_DIR, "*.json")
+    for path in glob.glob(pattern):
+        try:
+            if (os.path.basename(path) != EXITED
+                    and time.time() - os.path.getmtime(path) > settings.METRICS_SNAPSHOT_MAX_AGE):
+                _fold_exited(path)
+        except OSError:
+            continue  # removed meanwhile
+    snapshots = []
+    with _snapshots_lock(fcntl.LOCK_SH):  # no snapshot is folded in while they are read: it is counted once
+        for path in glob.glob(pattern):
+            try:
+                with open(path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                continue  # written by an older version
+            if data.get("pid") != exclude_pid:
+                snapshots.append(data["metrics"])
+    return snapshots
+
+
+@contextmanager
+def _snapshots_lock(operation: int) -> Iterator[None]:
+    with open(os.path.join(settings.METRICS_DIR, ".lock"), "a") as lock:
+        fcntl.flock(lock, operation)
+        yield
+
+
+def _fold_exited(path: str) -> None:
+    """Adds the snapshot of an exited process to the totals of the exited processes, then removes it. Under a file lock:
+    the processes that read the snapshots fold a snapshot in once."""
+    exited_path = os.path.join(settings.METRICS_DIR, EXITED)
+    with _snapshots_lock(fcntl.LOCK_EX):
+        try:
+            with open(path) as f:
+                expired = json.load(f)["metrics"]
+        except FileNotFoundError:
+            return  # folded in by another process
+        except (ValueError, KeyError):
+            expired = {}  # written by an older version
+        try:
+            with open(exited_path) as f:
+                exited = json.load(f)["metrics"]
+        except (OSError, ValueError, KeyError):
+            exited = {}
+        totals = {name: {**metric, "series": [[list(labels), value] for labels, value in metric["series"].items()]}
+                  for name, metric in merge([exited, expired]).items()}
+        _write_json(exited_path, {"metrics": totals})
+        os.remove(path)
+
+
+def render(include_snapshots: bool = True, include_own: bool = True) -> str:
+    """The metrics in the Prometheus text format: of this process (live), merged with the snapshots of the others,
+    followed by the gauges of the collectors."""
+    own = [snapshot()] if include_own else []
+    merged = merge(own + (read_snapshots(exclude_pid=os.getpid()) if include_snapshots else []))
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['type']}")
+        labelnames = metric["labelnames"]
+        for labels, value in sorted(metric["series"].items()):
+            if metric["type"] == "histogram":
+                cumulative = 0
+                for bound, count in zip([*metric["buckets"], "+Inf"], value):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labelnames, labels, le=bound)} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labelnames, labels)} {value[-2]}")
+                lines.append(f"{name}_count{_format_labels(labelnames, labels)} {value[-1]}")
+            else:
+                lines.append(f"{name}{_format_labels(labelnames, labels)} {value}")
+    for collector in _collectors:
+        for name, documentation, labelnames, values in collector():
+            lines.append(f"# HELP {name} {documentation}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(values.items()):
+                lines.append(f"{name}{_format_labels(labelnames, labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labelnames: Iterable[str], labels: Iterable, **extra) -> str:
+    pairs = [*zip(labelnames, labels), *extra.items()]
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def write_snapshot() -> None:
+    """Writes the snapshot of this process (temporary file, then rename), if it has any series."""
+    metrics = snapshot()
+    if not any(metric["series"] for metric in metrics.values()):
+        return
+    os.makedirs(settings.METRICS_DIR, exist_ok=True)
+    _write_json(os.path.join(settings.METRICS_DIR, f"{os.getpid()}.json"),
+                {"pid": os.getpid(), "time": time.time(), "metrics": metrics})
+
+
+def _write_json(path: str, data: dict) -> None:
+    """Writes a temporary file, then renames it (atomic): a reader gets the old or the new file."""
+    with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+        json.dump(data, f)
+    os.replace(f.name, path)
+
+
+_snapshot_writer_pid: Optional[int] = None
+
+
+def _ensure_snapshot_writer() -> None:
+    global _snapshot_writer_pid
+    if not settings.METRICS_DIR or _snapshot_writer_pid == os.getpid():
+        return
+    _snapshot_writer_pid = os.getpid()
+    threading.Thread(target=_write_snapshots, name="prm-metrics-snapshot", daemon=True).start()
+
+
+def _write_snapshots() -> None:
+    while True:
+        time.sleep(settings.METRICS_SNAPSHOT_INTERVAL)
+        try:
+            write_snapshot()
+        except OSError:
+            pass
+
+
+def _after_fork_in_child() -> None:
+    # A forked (worker) process starts from zero: the counts of the parent are reported by the parent.
+    global _snapshot_writer_pid
+    _snapshot_writer_pid = None
+    for metric in _registry.values():
+        metric._reset()
+    if _registry:
+        _ensure_snapshot_writer()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class _ExporterHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = render(include_own=False).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serves the merged metrics snapshots of the processes in METRICS_DIR.")
+    parser.add_argument("--port", type=int, default=9101)
+    args = parser.parse_args()
+    ThreadingHTTPServer(("", args.port), _ExporterHandler).serve_forever()
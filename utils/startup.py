@@ -0,0 +1,4 @@
+"""Imported first by main: when the API process started, for prm_app_startup_seconds."""
+import time
+
+started = time.perf_counter()